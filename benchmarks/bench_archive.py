@@ -0,0 +1,60 @@
+'''Writes messages to an archive and times it, then times a few typical
+moderation queries against it.
+
+Usage: python benchmarks/bench_archive.py [messages] [users]'''
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import chatango
+
+def make_messages(count, users, days=14):
+	room = chatango.chatroom("benchmark")
+	start = time.time() - days * 86400
+	step = days * 86400 / count
+	msgs = []
+	for x in range(count):
+		n = random.randrange(users)
+		args = ["%f" % (start + x * step), "user%i" % n, "", "%i" % (1000000000000000 + n), "umid%i" % n, "mid%i" % x, "10.0.0.%i" % (n % 256), "0", "<n000/><f x12000=\"0\">message number %i" % x]
+		msgs.append(room._parse_message(args))
+		msgs[-1].mid = "mid%i" % x
+	return msgs
+
+def timed(name, func, repeat=10):
+	start = time.perf_counter()
+	for x in range(repeat):
+		result = func()
+	took = (time.perf_counter() - start) / repeat
+	print("%-40s %9.2fms %8i results" % (name, took * 1000, len(result)))
+
+def main():
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+	users = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+	msgs = make_messages(count, users)
+	path = tempfile.mkdtemp()
+	try:
+		store = chatango.archive(path, segment_size=8 * 1024 * 1024)
+		start = time.perf_counter()
+		for msg in msgs:
+			store.write("benchmark", msg)
+		store.flush()
+		took = time.perf_counter() - start
+		size = sum(os.path.getsize(os.path.join(path, "benchmark", x)) for x in os.listdir(os.path.join(path, "benchmark")))
+		print("wrote %i messages in %.2fs, %.0f messages/s, %.1f MB on disk" % (count, took, count / took, size / 1024 / 1024))
+		now = time.time()
+		timed("one user, last 24h", lambda: list(store.query("benchmark", "user7", now - 86400)))
+		timed("one user, all time", lambda: list(store.query("benchmark", "user7")), 3)
+		timed("everyone, last hour", lambda: list(store.query("benchmark", start=now - 3600)))
+		timed("by mid with a rough time", lambda: [store.get("benchmark", msgs[-500].mid, msgs[-500].posttime - 60, msgs[-500].posttime + 60)])
+		timed("by mid", lambda: [store.get("benchmark", msgs[count // 2].mid)], 3)
+		store.close()
+	finally:
+		shutil.rmtree(path)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,51 @@
+'''Filters outgoing messages through a list of banned words, the way
+say() used to (one re.sub per word) and with the compiled pattern.
+
+Usage: python benchmarks/bench_badwords.py [words] [messages]'''
+
+import os
+import re
+import sys
+import time
+import random
+import string
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import chatango
+
+def make_word():
+	return "".join(random.choice(string.ascii_lowercase) for x in range(random.randint(3, 10)))
+
+def old_path(words, msgs):
+	special_chars = "\\.^$*+?{}[]|()"
+	bw_regx = []
+	for word in words:
+		for char in special_chars:
+			word = word.replace(char, "\\" + char)
+		bw_regx.append(word)
+	out = []
+	for msg in msgs:
+		for word in bw_regx:
+			msg = re.sub(word, "*", msg, flags=re.IGNORECASE)
+		out.append(msg)
+	return out
+
+def new_path(words, msgs):
+	bw_regx = chatango._word_pattern(words)
+	return [bw_regx.sub("*", msg) for msg in msgs]
+
+def main():
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+	total = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+	words = list(set(make_word() for x in range(count)))
+	vocabulary = [make_word() for x in range(2000)] + words[:50]
+	msgs = [" ".join(random.choice(vocabulary) for x in range(random.randint(3, 25))) for x in range(total)]
+	print("%i banned words, %i messages" % (len(words), len(msgs)))
+	for name, func in (("re.sub per word", old_path), ("compiled", new_path)):
+		start = time.perf_counter()
+		func(words, msgs)
+		took = time.perf_counter() - start
+		print("%-16s %8.3fs %10.0f messages/s" % (name, took, total / took))
+
+if __name__ == "__main__":
+	main()
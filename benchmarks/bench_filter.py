@@ -0,0 +1,141 @@
+'''Runs a stream of messages past a few hundred moderation rules, once as
+ignore() lambdas called one after another and once as msgfilter rules,
+and prints messages per second and the most expensive rules. Before
+timing anything it checks that both ways decide the same for every
+message.
+
+Usage: python benchmarks/bench_filter.py [messages] [rules]'''
+
+import os
+import re
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import chatango
+
+def make_messages(count, users=2000):
+	room = chatango.chatroom("benchmark")
+	words = ["hello", "lol", "anyone", "here", "watching", "the", "game", "link", "please", "thanks"]
+	msgs = []
+	for x in range(count):
+		n = random.randrange(users)
+		name = "" if n % 5 == 0 else "user%i" % n
+		text = " ".join(random.choice(words) for y in range(random.randint(3, 15)))
+		msgs.append(room._parse_message(["%f" % x, name, "", "%i" % (1000000000000000 + n), "umid%i" % n, "mid%i" % x, "10.0.%i.%i" % (n // 256 % 256, n % 256), "0", "<n%04i/>" % (n % 10000) + text]))
+		msgs[-1].type = chatango.chmessage.NEW
+	return msgs
+
+def make_message(room, n, text):
+	msg = room._parse_message(["%f" % n, "user%i" % n, "", "%i" % (1000000000000000 + n), "umid%i" % n, "mid%i" % n, "10.0.0.%i" % (n % 256), "0", "<n%04i/>" % (n % 10000) + text])
+	msg.type = chatango.chmessage.NEW
+	return msg
+
+def check(msgs):
+	# A rule with a backreference has to work alongside other patterns,
+	# which get merged into one alternation for the prefilter
+	f = chatango.msgfilter()
+	f.add("links", pattern="(x)y")
+	f.add("repeat", pattern="(\\w)\\1{4}")
+	room = chatango.chatroom("check")
+	assert f.match(make_message(room, 1, "aaaaaa hello")) == "repeat"
+	assert f.match(make_message(room, 2, "xy")) == "links"
+	assert f.match(make_message(room, 3, "hello")) is None
+	# And every rule decides the same as a lambda doing the same thing,
+	# rate rules aside as they count time
+	rules = [x for x in make_rules(300) if "rate" not in x[1]]
+	f = chatango.msgfilter()
+	funcs = []
+	for name, conditions in rules:
+		f.add(name, **conditions)
+		funcs.append((name, as_lambda(conditions)))
+	extra = [make_message(room, x, "hi badword3_1 there") for x in range(3)]
+	extra.append(make_message(room, 4, "see https://spam4.example"))
+	for msg in msgs + extra:
+		expected = next((name for name, func in funcs if func(msg)), None)
+		assert f.match(msg) == expected, (msg.content, f.match(msg), expected)
+	print("check:    msgfilter agrees with the lambdas")
+
+def make_rules(count):
+	# Roughly how a busy room's moderation list looks
+	rules = []
+	for x in range(count):
+		kind = x % 6
+		if kind == 0:
+			rules.append(("names%i" % x, dict(usernames=["spammer%i_%i" % (x, y) for y in range(20)])))
+		elif kind == 1:
+			rules.append(("uids%i" % x, dict(uids=[2000000000000000 + x * 20 + y for y in range(20)])))
+		elif kind == 2:
+			rules.append(("ips%i" % x, dict(ips=["192.168.%i.%i" % (x % 256, y) for y in range(20)])))
+		elif kind == 3:
+			rules.append(("words%i" % x, dict(words=["badword%i_%i" % (x, y) for y in range(10)])))
+		elif kind == 4:
+			rules.append(("pattern%i" % x, dict(pattern="https?://spam%i\\." % x)))
+		else:
+			rules.append(("anon words%i" % x, dict(user_type=chatango.chuser.ANON, words=["buy%i" % x, "cheap%i" % x])))
+	rules.append(("flood", dict(rate=(20, 10))))
+	return rules
+
+def as_lambda(conditions):
+	usernames = set(conditions.get("usernames", ()))
+	uids = set(conditions.get("uids", ()))
+	ips = set(conditions.get("ips", ()))
+	if "words" in conditions:
+		regx = re.compile("|".join(conditions["words"]), re.IGNORECASE)
+	elif "pattern" in conditions:
+		regx = re.compile(conditions["pattern"])
+	else:
+		regx = None
+	if usernames:
+		return lambda msg: msg.user.username in usernames
+	if uids:
+		return lambda msg: msg.user.uid in uids
+	if ips:
+		return lambda msg: msg.user.ip in ips
+	if "user_type" in conditions:
+		user_type = conditions["user_type"]
+		return lambda msg: msg.user.type == user_type and bool(regx.search(msg.content))
+	if regx:
+		return lambda msg: bool(regx.search(msg.content))
+	posts = {}
+	count, seconds = conditions["rate"]
+	def flood(msg):
+		times = posts.setdefault(msg.user.uid, [])
+		times.append(time.monotonic())
+		del times[:-count - 1]
+		return len(times) > count and times[-1] - times[0] <= seconds
+	return flood
+
+def run(name, room, msgs):
+	start = time.perf_counter()
+	for msg in msgs:
+		room._history.clear()
+		room._add_history(msg)
+	took = time.perf_counter() - start
+	print("%-9s %8i messages %8.3fs %10.0f messages/s" % (name, len(msgs), took, len(msgs) / took))
+
+def main():
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+	rules = make_rules(int(sys.argv[2]) if len(sys.argv) > 2 else 300)
+	msgs = make_messages(count)
+	check(msgs[:5000])
+	old = chatango.chatroom("benchmark")
+	old.limit_events(1)
+	for name, conditions in rules:
+		old.ignore(name, as_lambda(conditions))
+	# Every lambda ends up as a func rule, so this is the one by one path
+	run("lambdas", old, msgs)
+	new = chatango.chatroom("benchmark")
+	new.limit_events(1)
+	for name, conditions in rules:
+		new.get_filter().add(name, **conditions)
+	new.get_filter().time_rules()
+	run("msgfilter", new, msgs)
+	stats = new.get_filter().stats()
+	print("most expensive rules:")
+	for name, (hits, checks, took) in sorted(stats.items(), key=lambda x: -x[1][2])[:5]:
+		print("  %-16s %8i hits %8i checks %8.3fs" % (name, hits, checks, took))
+
+if __name__ == "__main__":
+	main()
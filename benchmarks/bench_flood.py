@@ -0,0 +1,69 @@
+'''Runs a stream of ordinary chat, with spam waves of the same and nearly
+the same text mixed in across many rooms, through a flooddetector and
+prints messages per second and the floods it found.
+
+Usage: python benchmarks/bench_flood.py [messages] [rooms]'''
+
+import gc
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import chatango
+
+random.seed(1)
+# A few hundred made up words, so ordinary chat rarely repeats itself
+WORDS = ["".join(random.choice("etaoinshrdlucmwfgypb") for y in range(random.randint(2, 8))) for x in range(500)]
+SPAM = ["free followers at spam%i dot com click now before it ends", "cheap watches and bags for sale visit shop%i today only"]
+
+def make_messages(count, rooms, users=5000):
+	room = chatango.chatroom("benchmark")
+	msgs = []
+	spam = 0
+	for x in range(count):
+		if x % 50 < 2:
+			# A spammer posting a wave, varying a word now and then
+			n = users + x // 50 % 20
+			words = (SPAM[x // 50 % 2] % (x // 1000)).split()
+			if x % 3 == 0:
+				words[random.randrange(len(words))] = random.choice(WORDS)
+			text = " ".join(words)
+			spam += 1
+		else:
+			n = random.randrange(users)
+			text = " ".join(random.choice(WORDS) for y in range(random.randint(3, 15)))
+		name = "" if n % 5 == 0 else "user%i" % n
+		msg = room._parse_message(["%f" % (x / 500), name, "", "%i" % (1000000000000000 + n), "umid%i" % n, "mid%i" % x, "10.0.%i.%i" % (n // 256 % 256, n % 256), "0", "<n%04i/>" % (n % 10000) + text])
+		msg.type = chatango.chmessage.NEW
+		msg.mid = "mid%i" % x
+		msg.content
+		msgs.append((msg, "room%i" % (x % rooms)))
+	return msgs, spam
+
+def main():
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+	rooms = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+	msgs, spam = make_messages(count, rooms)
+	# A client only ever holds a room's recent history, not every message
+	# of the run, so keep those out of the garbage collector's way
+	gc.collect()
+	gc.freeze()
+	detector = chatango.flooddetector()
+	kinds = {}
+	flagged = set()
+	start = time.perf_counter()
+	for msg, room in msgs:
+		for kind, posts in detector.check(msg, room):
+			kinds[kind] = kinds.get(kind, 0) + 1
+			flagged.update(x[2] for x in posts)
+	took = time.perf_counter() - start
+	print("%8i messages %8.3fs %10.0f messages/s" % (count, took, count / took))
+	print("%8i spam messages, %i flagged as part of a flood" % (spam, len(flagged)))
+	for kind, n in sorted(kinds.items()):
+		print("  %-10s %8i floods" % (kind, n))
+	print(detector.stats())
+
+if __name__ == "__main__":
+	main()
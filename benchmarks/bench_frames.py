@@ -0,0 +1,102 @@
+'''Replays a captured chatango stream through the old buffer handling
+and through framedecoder, and prints how long each took.
+
+Usage: python benchmarks/bench_frames.py [capture file]
+
+Without a capture file, a 10 MB stream of history, message and
+participant frames is generated.'''
+
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import chatango
+
+class fakesock:
+	def __init__(self, data, chunk=8192):
+		self._view = memoryview(data)
+		self._pos = 0
+		self._chunk = chunk
+
+	def recv(self, size):
+		size = min(size, self._chunk)
+		data = bytes(self._view[self._pos:self._pos + size])
+		self._pos += len(data)
+		return data
+
+	def recv_into(self, buf):
+		size = min(len(buf), self._chunk, len(self._view) - self._pos)
+		buf[:size] = self._view[self._pos:self._pos + size]
+		self._pos += size
+		return size
+
+def make_stream(size=10 * 1024 * 1024):
+	frames = []
+	total = 0
+	n = 0
+	while total < size:
+		n += 1
+		kind = random.random()
+		if kind < 0.4:
+			frame = "i:%f:user%i::1234%i:umid%i:mid%i:1.2.3.4:0:<n000/><f x12000=\"0\">%s" % (time.time(), n % 50, n, n, n, "spam " * random.randint(1, 60))
+		elif kind < 0.7:
+			frame = "b:%f:user%i::1234%i:umid%i:idx%i:1.2.3.4:0:<n000/>%s" % (time.time(), n % 50, n, n, n, "text " * random.randint(1, 30))
+		elif kind < 0.85:
+			frame = "u:idx%i:mid%i" % (n, n)
+		else:
+			frame = "participant:1:%i:1234%i:user%i:None:1.2.3.4:%f" % (n, n, n, time.time())
+		frame = frame.encode() + b"\r\n\x00"
+		frames.append(frame)
+		total += len(frame)
+	return b"".join(frames)
+
+def old_path(sock, total):
+	# The buffer handling chatroom._recv used to do
+	buffer_ = b''
+	count = 0
+	read = 0
+	while read < total or b'\x00' in buffer_.lstrip(b'\x00'):
+		while buffer_.startswith(b'\x00'):
+			buffer_ = buffer_[1:]
+		while not b'\x00' in buffer_:
+			next = sock.recv(8192)
+			read += len(next)
+			buffer_ += next
+		buffer = buffer_.split(b'\x00')
+		data = b'\r\n'
+		while data == b'\r\n':
+			data = buffer.pop(0)
+		data = data.strip(b'\r\n').decode()
+		buffer_ = b'\x00'.join(buffer)
+		event = data.split(":")[0]
+		args = data.split(":")[1:]
+		count += 1
+	return count
+
+def new_path(sock, total):
+	decoder = chatango.framedecoder()
+	count = 0
+	while decoder.recv_into(sock):
+		for data in decoder.frames():
+			data = data.split(":")
+			event, args = data[0], data[1:]
+			count += 1
+	return count
+
+def main():
+	if len(sys.argv) > 1:
+		with open(sys.argv[1], "rb") as f:
+			stream = f.read()
+	else:
+		stream = make_stream()
+	print("stream: %.1f MB" % (len(stream) / 1024 / 1024))
+	for name, func in (("old", old_path), ("framedecoder", new_path)):
+		start = time.perf_counter()
+		count = func(fakesock(stream), len(stream))
+		took = time.perf_counter() - start
+		print("%-13s %8i frames %8.3fs %10.0f frames/s" % (name, count, took, count / took))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,81 @@
+'''Measures how many bytes each message retained in a room's history
+costs, with the old dict based chuser/chmessage and with the current
+slotted ones.
+
+Usage: python benchmarks/bench_memory.py [messages] [users]'''
+
+import os
+import sys
+import random
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import chatango
+
+class olduser:
+	def __init__(self, username="", uid=None, umid=None, session=None, logintime=None, type=None, ip=None, ts=None):
+		self._username = username
+		self._ts = ts
+		self.uid = int(uid) if uid != None else chatango.chuser._get_uid()
+		self.umid = umid
+		self.session = int(session) if session != None else session
+		self.logintime = float(logintime) if logintime != None else logintime
+		self.type = type
+		self.ip = ip
+
+class oldmessage:
+	def __init__(self, **kwargs):
+		for keyword in kwargs:
+			setattr(self, keyword, kwargs[keyword])
+
+def make_frames(count, users):
+	frames = []
+	for x in range(count):
+		n = random.randrange(users)
+		frames.append(["%f" % (1500000000 + x), "user%i" % n, "", "%i" % (1000000000000000 + n), "umid%i" % n, "mid%i" % x, "10.0.%i.%i" % (n // 256 % 256, n % 256), "0", "<n000/><f x12000=\"0\">message number %i" % x])
+	return frames
+
+def old_path(frames):
+	history = []
+	for args in frames:
+		posttime, reg_name, tmp_name, uid, umid, index, ip, x = args[:8]
+		msg = ":".join(args[8:])
+		u = olduser(username=reg_name, uid=uid, umid=umid, ip=ip, type=chatango.chuser.REGD, ts="")
+		msg = oldmessage(posttime=posttime, formatted=msg, content=msg[22:], umid=umid, index=index, user=u)
+		msg.type = chatango.chmessage.HISTORY
+		del msg.index
+		msg.mid = index
+		history.append(msg)
+	return history
+
+def new_path(frames):
+	room = chatango.chatroom("benchmark")
+	history = []
+	for args in frames:
+		msg = room._parse_message(args)
+		msg.type = chatango.chmessage.HISTORY
+		msg.mid = msg.index
+		del msg.index
+		history.append(msg)
+	return room, history
+
+def measure(func, frames):
+	tracemalloc.start()
+	before = tracemalloc.get_traced_memory()[0]
+	kept = func(frames)
+	after = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	return after - before, kept
+
+def main():
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+	users = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+	frames = make_frames(count, users)
+	# The strings come off the wire either way, so only count what the objects add
+	for name, func in (("dict based", old_path), ("slotted", new_path)):
+		used, kept = measure(func, frames)
+		print("%-11s %8i messages %8.1f MB %6i bytes/message" % (name, count, used / 1024 / 1024, used / count))
+		del kept
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,110 @@
+'''Runs chatrooms against the local fake server and prints the numbers
+worth watching for regressions: frame parse throughput, events a second
+through get_event, the cost of a history insertion, and memory per room
+at 1, 100 and 1000 rooms.
+
+Usage: python benchmarks/bench_protocol.py [capture file]
+
+With a capture file (see chatroom.record()) the parse benchmark replays
+it, otherwise a generated stream of messages and participant frames.'''
+
+import os
+import sys
+import time
+import random
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import chatango
+from fakeserver import fakeserver, replay, make_stream
+
+def bench_parse(stream):
+	room = chatango.chatroom("benchmark")
+	room.limit_events(10000)
+	start = time.perf_counter()
+	count = replay(room, stream)
+	took = time.perf_counter() - start
+	print("parse:        %8i frames %8.3fs %10.0f frames/s %8.1f MB/s" % (count, took, count / took, len(stream) / took / 1024 / 1024))
+
+def bench_events(server, count=50000):
+	loop = chatango.engine()
+	room = chatango.chatroom("eventsroom", engine=loop)
+	room.login()
+	stream = make_stream(count * 2, seed=1)
+	messages = stream.count(b"\x00b:")
+	start = time.perf_counter()
+	server.send("eventsroom", stream)
+	seen = 0
+	while seen < messages:
+		if room.get_event()["event"] == "message":
+			seen += 1
+	took = time.perf_counter() - start
+	print("get_event:    %8i events %8.3fs %10.0f events/s" % (seen, took, seen / took))
+	room.disconnect()
+	loop.stop()
+
+def bench_history(count=200000):
+	room = chatango.chatroom("benchmark")
+	msgs = []
+	for x in range(count):
+		n = random.randrange(500)
+		msg = room._parse_message(["%f" % (1500000000 + x), "user%i" % n, "", "%i" % (1000000000000000 + n), "umid%i" % n, "mid%i" % x, "10.0.0.1", "0", "<n000/>message %i" % x])
+		msg.mid = "mid%i" % x
+		msgs.append(msg)
+	shuffled = list(msgs)
+	for x in range(0, len(shuffled) - 1, 10):
+		# Every tenth message arrives a little late
+		shuffled[x], shuffled[x + 1] = shuffled[x + 1], shuffled[x]
+	for limit in (100, 10000):
+		for name, order in (("in order", msgs), ("out of order", shuffled)):
+			history = chatango.chhistory(limit)
+			start = time.perf_counter()
+			for msg in order:
+				history.add(msg)
+			took = time.perf_counter() - start
+			print("history:      limit %-6i %-13s %8.2fus/insert" % (limit, name, took / count * 1000000))
+
+def bench_rooms(server, count):
+	loop = chatango.engine()
+	names = ["mem%iroom%i" % (count, x) for x in range(count)]
+	for name in names:
+		for x in range(20):
+			server.say(name, "user%i" % x, "<n000/>history message %i" % x)
+		for x in range(20):
+			server.join(name, "user%i" % x)
+	tracemalloc.start()
+	before = tracemalloc.get_traced_memory()[0]
+	start = time.perf_counter()
+	s = chatango.session(engine=loop, max_parallel=32)
+	rooms = s.join_all(names)
+	joined = time.perf_counter() - start
+	# Let the participant lists arrive
+	while sum(len(x._online) for x in rooms.values()) < count * 20:
+		time.sleep(0.05)
+	after = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	print("rooms:        %8i rooms %8.3fs to join %10.1f KB/room" % (count, joined, (after - before) / count / 1024))
+	s.disconnect()
+	loop.stop()
+
+def main():
+	if len(sys.argv) > 1:
+		with open(sys.argv[1], "rb") as f:
+			stream = f.read()
+	else:
+		stream = make_stream(seed=0)
+	chatango.debug(False)
+	server = fakeserver()
+	chatango.use_server(*server.address)
+	try:
+		bench_parse(stream)
+		bench_events(server)
+		bench_history()
+		for count in (1, 100, 1000):
+			bench_rooms(server, count)
+	finally:
+		chatango.use_server(None)
+		server.stop()
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,85 @@
+'''Queues outgoing messages the way a busy bot does and prints messages
+per second: chatroom.say() with a font set, the same with the font
+formatted and the frame built on every call like before, long messages
+that get split into several frames, and PMs. Before timing anything it
+checks that long messages split into full frames, never cutting a word
+or leaving a piece next to empty.
+
+Usage: python benchmarks/bench_say.py [messages]'''
+
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import chatango
+from fakeserver import nullsock
+
+def connect(conn):
+	conn._sock = nullsock()
+	conn._connected = True
+	return conn
+
+def make_room():
+	room = connect(chatango.chatroom("benchmark"))
+	room._user.type = chatango.chuser.REGD
+	room.set_font(size=12, family="arial", color="ff0000", name="00ff00")
+	return room
+
+def say_before(room, msg):
+	# What say() did before: the font formatted and the frame joined and
+	# encoded on every call
+	font = room._font
+	msg = msg.replace("<", "&lt;")
+	prefix = '<n%s/><f x%s%s="%s">' % (font.get("name") or "", font.get("size") or "", font.get("color") or "", chatango._font_family.get(font.get("family")) or "")
+	room._send("bmsg:t12r", prefix + msg)
+
+def check():
+	# A PM of many lines is measured as it'll be wrapped, every newline
+	# becoming </P><P>, and split at newlines rather than mid word
+	pm = connect(chatango.pms("check", ""))
+	sent = []
+	pm._queue = lambda data, done=None: sent.append(data)
+	pm.send("bob", "line\n" * 1000)
+	limit = chatango._MESSAGE_LIMIT
+	wrapped = len(chatango._pm_body("line\n" * 1000))
+	assert len(sent) == -(-wrapped // limit), len(sent)
+	for frame in sent:
+		body = frame.decode()[len("msg:bob:"):-len("\r\n\x00")]
+		assert limit // 2 <= len(body) <= limit, body
+		assert body.startswith("<P>line</P>"), body[:20]
+	# And a room message with nowhere good to split still gets full pieces
+	room = make_room()
+	for text in ("<b>" + "x" * 3000 + "</b>", "word " * 2000, "&amp;" * 1000):
+		pieces = chatango._split_message(text, limit)
+		assert all(limit // 2 <= len(x) <= limit for x in pieces), [len(x) for x in pieces]
+		assert all(x.rfind("<") <= x.rfind(">") and x.rfind("&") <= x.rfind(";") for x in pieces)
+	print("check:         long messages split into full pieces")
+
+def run(name, func, msgs):
+	start = time.perf_counter()
+	for msg in msgs:
+		func(msg)
+	took = time.perf_counter() - start
+	print("%-14s %8i messages %8.3fs %10.0f messages/s" % (name, len(msgs), took, len(msgs) / took))
+
+def main():
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+	words = ["hello", "there", "<b>bold</b>", "a", "quick", "message", "&", "<3", "from", "the", "bot"]
+	short = [" ".join(random.choice(words) for y in range(random.randint(3, 30))) for x in range(count)]
+	long = [" ".join(random.choice(words) for y in range(1000)) for x in range(count // 10)]
+	check()
+	room = make_room()
+	run("say before", lambda x: say_before(room, x), short)
+	room = make_room()
+	run("say", lambda x: room.say(x, False), short)
+	room = make_room()
+	frames = room._frames_out
+	run("say long", lambda x: room.say(x, False), long)
+	print("%-14s %8.1f frames a message" % ("", (room._frames_out - frames) / len(long)))
+	pm = connect(chatango.pms("benchmark", ""))
+	run("pms.send", lambda x: pm.send("someone", x), short)
+
+if __name__ == "__main__":
+	main()
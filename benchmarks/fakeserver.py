@@ -0,0 +1,352 @@
+'''A local stand in for chatango's chatroom servers, and helpers for
+replaying captured streams, so chatango.py can be exercised without
+going anywhere near s*.chatango.com.
+
+Ex:
+	server = fakeserver()
+	chatango.use_server(*server.address)
+	room = chatango.chatroom("room"); room.login()
+	server.say("room", "someone", "hello")
+	room.get_event()
+
+It speaks enough of the protocol for chatrooms: bauth (answered with
+ok, a few history i frames and inited), g_participants, bmsg (echoed
+back as b and u to everyone in the room), blogin/blogout and pings,
+and sends participant frames as people come and go. PMs log in
+through chatango's website, so they can't be pointed here.'''
+
+import time
+import random
+import socket
+import selectors
+import threading
+import collections
+
+class fakeserver:
+	def __init__(self, host="127.0.0.1", port=0, history=20):
+		'''Listen on host:port (any free port by default). Each room
+		keeps its last history messages to send to whoever joins.'''
+		self.history = history
+		self._listener = socket.socket()
+		self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self._listener.bind((host, port))
+		self._listener.listen(1024)
+		self._listener.setblocking(False)
+		self.address = self._listener.getsockname()
+		self._selector = selectors.DefaultSelector()
+		self._selector.register(self._listener, selectors.EVENT_READ)
+		self._waker, self._wake = socket.socketpair()
+		self._waker.setblocking(False)
+		self._selector.register(self._waker, selectors.EVENT_READ)
+		self._calls = collections.deque()
+		self._clients = {}
+		self._rooms = collections.defaultdict(fakeroom)
+		self._count = 0
+		self._running = True
+		self._thread = threading.Thread(target=self._run, daemon=True)
+		self._thread.start()
+
+	# ------------------
+	 # Interface methods
+
+	def say(self, room, username, text, uid=None):
+		'''Post a message in a room as username, the way chatango sends
+		one: a b frame followed by a u frame giving it its mid.'''
+		self._call(self._say, room.lower(), username, text, uid)
+
+	def join(self, room, username):
+		'''Have a registered user join a room.'''
+		self._call(self._join, room.lower(), username)
+
+	def leave(self, room, username):
+		'''Have a user joined with join() leave again.'''
+		self._call(self._leave, room.lower(), username)
+
+	def send(self, room, data):
+		'''Send raw bytes (whole frames, or a captured stream) to every
+		client in a room.'''
+		self._call(self._broadcast, room.lower(), bytes(data))
+
+	def replay(self, room, path):
+		'''Send a stream captured with chatroom.record() to every client
+		in a room.'''
+		with open(path, "rb") as f:
+			self.send(room, f.read())
+
+	def clients(self, room=None):
+		'''How many clients are connected, to one room or to any.'''
+		if room is None:
+			return len(self._clients)
+		return len(self._rooms[room.lower()].clients)
+
+	def kick_all(self):
+		'''Drop every client's connection, to test reconnecting.'''
+		self._call(self._kick_all)
+
+	def stop(self):
+		'''Stop listening and close every connection.'''
+		self._call(self._stop)
+		self._thread.join()
+
+	# ---------------
+	 # Helper methods
+
+	def _call(self, func, *args):
+		self._calls.append((func, args))
+		try:
+			self._wake.send(b"\x00")
+		except OSError:
+			pass
+
+	def _run(self):
+		while self._running:
+			for key, mask in self._selector.select():
+				if key.fileobj is self._listener:
+					self._accept()
+				elif key.fileobj is self._waker:
+					try:
+						self._waker.recv(4096)
+					except BlockingIOError:
+						pass
+				elif mask & selectors.EVENT_READ:
+					self._readable(key.fileobj)
+				if mask & selectors.EVENT_WRITE and key.fileobj in self._clients:
+					self._writable(key.fileobj)
+			while self._calls:
+				func, args = self._calls.popleft()
+				func(*args)
+		for sock in list(self._clients):
+			self._drop(sock)
+		self._selector.close()
+		self._listener.close()
+		self._waker.close()
+		self._wake.close()
+
+	def _stop(self):
+		self._running = False
+
+	def _accept(self):
+		while True:
+			try:
+				sock, address = self._listener.accept()
+			except BlockingIOError:
+				return
+			sock.setblocking(False)
+			self._clients[sock] = fakeclient(address[0])
+			self._selector.register(sock, selectors.EVENT_READ)
+
+	def _readable(self, sock):
+		client = self._clients[sock]
+		try:
+			data = sock.recv(65536)
+		except BlockingIOError:
+			return
+		except OSError:
+			data = b""
+		if not data:
+			self._drop(sock)
+			return
+		client.inbuf += data
+		*frames, client.inbuf = client.inbuf.split(b"\x00")
+		for frame in frames:
+			frame = frame.strip(b"\r\n").decode("utf-8", "replace")
+			if frame:
+				self._handle(sock, client, frame.split(":"))
+			if sock not in self._clients:
+				return
+
+	def _writable(self, sock):
+		client = self._clients[sock]
+		try:
+			sent = sock.send(client.outbuf)
+		except BlockingIOError:
+			return
+		except OSError:
+			self._drop(sock)
+			return
+		del client.outbuf[:sent]
+		if not client.outbuf:
+			self._selector.modify(sock, selectors.EVENT_READ)
+
+	def _write(self, sock, data):
+		client = self._clients[sock]
+		if not client.outbuf:
+			try:
+				sent = sock.send(data)
+			except BlockingIOError:
+				sent = 0
+			except OSError:
+				self._drop(sock)
+				return
+			data = data[sent:]
+			if not data:
+				return
+			self._selector.modify(sock, selectors.EVENT_READ | selectors.EVENT_WRITE)
+		client.outbuf += data
+
+	def _frame(self, *args):
+		return ":".join([str(x) for x in args]).encode() + b"\r\n\x00"
+
+	def _drop(self, sock):
+		client = self._clients.pop(sock)
+		self._selector.unregister(sock)
+		sock.close()
+		if client.room is not None:
+			room = self._rooms[client.room]
+			room.clients.discard(sock)
+			del room.participants[client.session]
+			self._broadcast(client.room, self._participant(0, client))
+
+	def _kick_all(self):
+		for sock in list(self._clients):
+			self._drop(sock)
+
+	def _handle(self, sock, client, args):
+		command, args = args[0], args[1:]
+		if command == "bauth":
+			self._bauth(sock, client, args)
+		elif command == "g_participants":
+			room = self._rooms[client.room]
+			self._write(sock, self._frame("g_participants", ";".join([self._listing(x) for x in room.participants.values()])))
+		elif command == "bmsg":
+			self._say(client.room, client.name if client.type != "N" else "", ":".join(args[1:]), client.uid, client)
+		elif command == "blogin":
+			client.name = args[0]
+			client.type = "M" if len(args) > 1 else "C"
+			self._write(sock, self._frame("pwdok" if client.type == "M" else "aliasok"))
+		elif command == "blogout":
+			client.type = "N"
+			self._write(sock, self._frame("logoutok"))
+
+	def _bauth(self, sock, client, args):
+		self._count += 1
+		client.room = args[0].lower()
+		client.session = self._count
+		client.uid = int(args[1]) if len(args) > 1 and args[1].isdigit() else 1000000000000000 + self._count
+		client.name = args[2] if len(args) > 2 else ""
+		client.type = "M" if len(args) > 3 else "N"
+		client.logintime = time.time()
+		room = self._rooms[client.room]
+		data = [self._frame("ok", "owner", client.uid, client.type, client.name, "%f" % client.logintime, client.ip, "")]
+		for msg in room.history:
+			data.append(self._frame("i", *msg))
+		data.append(self._frame("inited"))
+		self._write(sock, b"".join(data))
+		self._broadcast(client.room, self._participant(1, client))
+		room.clients.add(sock)
+		room.participants[client.session] = client
+
+	def _say(self, name, username, text, uid=None, client=None):
+		room = self._rooms[name]
+		self._count += 1
+		uid = uid or 1000000000000000 + abs(hash(username)) % 1000000000000
+		ip = client.ip if client else "127.0.0.1"
+		msg = ["%f" % time.time(), username, "", uid, "umid%i" % uid, "mid%i" % self._count, ip, "0", text]
+		index = "idx%i" % self._count
+		self._broadcast(name, self._frame("b", *msg[:5], index, *msg[6:]) + self._frame("u", index, msg[5]))
+		room.history.append(msg)
+		while len(room.history) > self.history:
+			room.history.popleft()
+
+	def _join(self, name, username):
+		self._count += 1
+		client = fakeclient("127.0.0.1")
+		client.session = self._count
+		client.uid = 1000000000000000 + self._count
+		client.name = username
+		client.type = "M"
+		client.logintime = time.time()
+		client.room = name
+		room = self._rooms[name]
+		room.participants[client.session] = client
+		room.fake[username.lower()] = client
+		self._broadcast(name, self._participant(1, client))
+
+	def _leave(self, name, username):
+		room = self._rooms[name]
+		client = room.fake.pop(username.lower(), None)
+		if client:
+			del room.participants[client.session]
+			self._broadcast(name, self._participant(0, client))
+
+	def _broadcast(self, name, data):
+		for sock in list(self._rooms[name].clients):
+			if sock in self._clients:
+				self._write(sock, data)
+
+	def _participant(self, event, client):
+		reg_name, tmp_name = self._names(client)
+		return self._frame("participant", event, client.session, client.uid, reg_name, tmp_name, client.ip, "%f" % client.logintime)
+
+	def _listing(self, client):
+		reg_name, tmp_name = self._names(client)
+		return "%i:%f:%i:%s:%s:None" % (client.session, client.logintime, client.uid, reg_name, tmp_name)
+
+	def _names(self, client):
+		if client.type == "M":
+			return client.name, "None"
+		elif client.type == "C":
+			return "None", client.name
+		return "None", "None"
+
+class fakeroom:
+	def __init__(self):
+		self.clients = set()
+		self.participants = {}
+		self.fake = {}
+		self.history = collections.deque()
+
+class fakeclient:
+	def __init__(self, ip):
+		self.ip = ip
+		self.inbuf = b""
+		self.outbuf = bytearray()
+		self.room = None
+		self.session = None
+		self.uid = None
+		self.name = ""
+		self.type = "N"
+		self.logintime = None
+
+class nullsock:
+	def sendall(self, data):
+		pass
+
+	def send(self, data):
+		return len(data)
+
+	def close(self):
+		pass
+
+def replay(conn, data, chunk=8192):
+	'''Feed a captured stream straight into a chatroom or pms object,
+	handling every frame in it as if it had come off the socket.
+	If it isn't connected, anything it sends back is thrown away.
+	Returns how many frames there were.'''
+	if not conn._connected:
+		conn._sock = nullsock()
+		conn._connected = True
+	count = 0
+	view = memoryview(data)
+	for x in range(0, len(view), chunk):
+		for event, args in conn._feed(view[x:x + chunk]):
+			conn._handle(event, args)
+			count += 1
+	return count
+
+def make_stream(frames=100000, users=50, seed=None):
+	'''Generate a stream of new messages, as b and u frame pairs, and
+	participant frames, like a busy room sends.'''
+	rand = random.Random(seed)
+	data = []
+	now = time.time()
+	n = 0
+	while len(data) < frames:
+		n += 1
+		user = rand.randrange(users)
+		if n % 5 == 0:
+			data.append("participant:%i:%i:%i:user%i:None:10.0.0.%i:%f" % (n % 2, user, 1000000000000000 + user, user, user % 256, now))
+		else:
+			data.append("b:%f:user%i::%i:umid%i:idx%i:10.0.0.%i:0:<n000/><f x12000=\"0\">%s" % (now + n, user, 1000000000000000 + user, user, n, user % 256, "words " * rand.randint(1, 30)))
+			data.append("u:idx%i:mid%i" % (n, n))
+	return ("\r\n\x00".join(data) + "\r\n\x00").encode()
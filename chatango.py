@@ -1,10 +1,24 @@
+import os
 import re
 import sys
+import mmap
+import struct
+import marshal
+import hashlib
+import logging
 import time
 import queue
+import bisect
+import heapq
 import random
+import functools
+import collections
 import socket
+import asyncio
 import _thread
+import threading
+import multiprocessing
+import weakref
 import urllib.parse
 import html.entities
 import urllib.request
@@ -21,6 +35,7 @@ class chuser:
 	ANON = 0
 	TEMP = 1
 	REGD = 2
+	__slots__ = ("_username", "_ts", "uid", "umid", "session", "logintime", "type", "ip", "password", "__weakref__")
 	
 	def __init__(self, username="", uid=None, umid=None, session=None, logintime=None, type=None, ip=None, ts=None):
 		'''Holds user data information. displayname gives the person's
@@ -29,6 +44,7 @@ class chuser:
 		You really don't need to worry about the rest.'''
 		self._username = username
 		self._ts = ts
+		self.password = None
 		self.uid = int(uid) if uid != None else self._get_uid()
 		self.umid = umid
 		self.session = int(session) if session != None else session
@@ -49,22 +65,1799 @@ class chuser:
 class chmessage:
 	HISTORY = 0
 	NEW = 1
-	def __init__(self, **kwargs):
-		# This should hold: posttime, user, content, formatted, mid, umid, index
-		for keyword in kwargs:
-			setattr(self, keyword, kwargs[keyword])
+	__slots__ = ("posttime", "user", "_content", "formatted", "mid", "umid", "index", "type")
+	
+	def __init__(self, posttime=None, user=None, content=None, formatted=None, mid=None, umid=None, index=None, type=None):
+		# The plain text content is only worked out from formatted if someone asks for it
+		self.posttime = posttime
+		self.user = user
+		self._content = content
+		self.formatted = formatted
+		self.mid = mid
+		self.umid = umid
+		self.index = index
+		self.type = type
+	content = property(lambda x: x._get_content(), lambda x, y: setattr(x, "_content", y))
+	name_color = property(lambda x: _message_font(x.formatted or "")[0])
+	font_color = property(lambda x: _message_font(x.formatted or "")[1])
+	font_size = property(lambda x: _message_font(x.formatted or "")[2])
+	font_face = property(lambda x: _message_font(x.formatted or "")[3])
+	
+	def _get_content(self):
+		if self._content is None and self.formatted is not None:
+			self._content = _message_text(self.formatted)
+		return self._content
+
+# ------------------------------------------
+# Outgoing frames, batched and rate limited
+# ------------------------------------------
+
+class ratelimit:
+	def __init__(self, rate, burst=None):
+		'''Token bucket letting through rate frames a second on average,
+		in bursts of up to burst frames (rate, by default).'''
+		self.rate = float(rate)
+		self.burst = float(burst or max(rate, 1))
+		self._tokens = self.burst
+		self._stamp = time.monotonic()
+		self._lock = threading.Lock()
+
+	def acquire(self, count):
+		'''Take up to count tokens, returning how many were taken.'''
+		with self._lock:
+			self._refill()
+			count = min(count, int(self._tokens))
+			self._tokens -= count
+			return count
+
+	def refund(self, count):
+		'''Give back tokens that ended up not being used.'''
+		with self._lock:
+			self._tokens = min(self.burst, self._tokens + count)
+
+	def wait(self):
+		'''Seconds until the next token is available.'''
+		with self._lock:
+			self._refill()
+			return max(0.0, (1 - self._tokens) / self.rate)
+
+	def _refill(self):
+		now = time.monotonic()
+		self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+		self._stamp = now
+
+class sendqueue:
+	def __init__(self, limit=None):
+		'''Holds the frames waiting to be written to a connection, so
+		everything that piles up between writes goes out in one go,
+		as fast as the connection's ratelimit (and the global one set
+		with limit_sends()) allow.'''
+		self.limit = limit
+		self.sent = 0
+		self.flushes = 0
+		self.max_latency = 0.0
+		self._latency = 0.0
+		self._frames = collections.deque()
+		self._taken = []
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self._frames)
+
+	def push(self, data, done=None):
+		'''Queue an encoded frame. done() is called once it's been
+		written out, see written().'''
+		self._frames.append((data, time.monotonic(), done))
+
+	def requeue(self, data):
+		'''Put data that couldn't be written back at the front.'''
+		self._frames.appendleft((data, time.monotonic(), None))
+
+	def written(self):
+		'''Everything taken so far has been written to the socket, so
+		call the done callbacks of the frames in it.'''
+		if self._taken:
+			with self._lock:
+				taken, self._taken = self._taken, []
+			for done in taken:
+				done()
+
+	def unwritten(self):
+		'''What was taken got thrown away without being written, so
+		forget its done callbacks.'''
+		with self._lock:
+			self._taken = []
+
+	def take(self):
+		'''Take as many frames as the rate limits allow right now. Returns
+		the joined frames, and how many seconds to wait before trying
+		again if some had to be held back.'''
+		with self._lock:
+			count = len(self._frames)
+			if not count:
+				return b'', 0
+			limits = [x for x in (self.limit, _send_limit) if x]
+			for x, limit in enumerate(limits):
+				granted = limit.acquire(count)
+				if granted < count:
+					for earlier in limits[:x]:
+						earlier.refund(count - granted)
+				count = granted
+			if not count:
+				return b'', max(x.wait() for x in limits)
+			frames = [self._frames.popleft() for x in range(count)]
+			self._taken.extend([x[2] for x in frames if x[2]])
+			latency = time.monotonic() - frames[0][1]
+			self.max_latency = max(self.max_latency, latency)
+			self._latency += latency
+			self.flushes += 1
+			self.sent += count
+			wait = max(x.wait() for x in limits) if self._frames and limits else 0
+			return b''.join([x[0] for x in frames]), wait
+
+	def stats(self):
+		'''Returns the queue depth, how many frames have been sent in how
+		many writes, and the average and worst time a frame waited.'''
+		return {
+			"queued": len(self._frames),
+			"sent": self.sent,
+			"flushes": self.flushes,
+			"latency": self._latency / self.flushes if self.flushes else 0.0,
+			"max_latency": self.max_latency,
+		}
+
+class msgbuilder:
+	def __init__(self, command, limit=None, wrap=None):
+		'''Builds the frames for outgoing messages, as bytes ready to be
+		queued. The command and a prefix (like a font) are encoded once
+		rather than on every message. Anything over limit characters is
+		split into consecutive messages, at a newline, a space or between
+		tags where it can be, never inside a tag or an entity. limit is the
+		server's 1800 by default. If given, wrap(piece) dresses up each
+		piece after splitting, and still has to fit in the limit, so
+		what it adds is measured while splitting: once around the piece,
+		and again for every newline or tab it makes longer (as PMs do).'''
+		self.command = command
+		self.limit = limit or _MESSAGE_LIMIT
+		self.wrap = wrap
+		self._widths = None
+		self._overhead = 0
+		if wrap is not None:
+			self._overhead = len(wrap(""))
+			self._widths = dict((x, len(wrap(x)) - self._overhead) for x in "\n\t")
+		self.set_prefix("")
+	
+	def set_prefix(self, prefix):
+		'''Put prefix ahead of every message built from now on.'''
+		self.prefix = prefix
+		self._prefix = prefix.encode()
+		self._head = (self.command + ":").encode()
+		self._prefixed = self._head + self._prefix
+	
+	def build(self, body, *args, prefix=True):
+		'''Returns the frames saying body, with args (like a username)
+		between the command and the message.'''
+		return self._frames(self._pieces(body), args, prefix)
+	
+	def _pieces(self, body, limit=None):
+		limit = limit or self.limit
+		wrap = self.wrap
+		if wrap is None:
+			return [x.encode() for x in _split_message(body, limit)]
+		pieces = []
+		for piece in _split_message(body, max(1, limit - self._overhead), self._widths):
+			wrapped = wrap(piece)
+			if len(wrapped) > self.limit:
+				# Wrapping grew something besides newlines and tabs; split
+				# it again, smaller by as much as it grew
+				pieces.extend(self._pieces(piece, max(1, len(piece) * self.limit // len(wrapped))))
+			else:
+				pieces.append(wrapped.encode())
+		return pieces
+	
+	def _frames(self, pieces, args, prefix):
+		if args:
+			head = (":".join([self.command] + [_to_str(x) for x in args]) + ":").encode()
+			if prefix:
+				head += self._prefix
+		else:
+			head = self._prefixed if prefix else self._head
+		return [head + x + b"\r\n\x00" for x in pieces]
+
+# ---------------------------------------
+# Events, and the queues that hold them
+# ---------------------------------------
+
+class chevent(dict):
+	__slots__ = ("_stamp",)
+
+	def reply(self, msg):
+		'''Reply to whatever caused the event, in the same room or PM.'''
+		if "room" in self:
+			self["room"].say(msg)
+		else:
+			self["pms"].send(self["username"], msg)
+
+	def __missing__(self, key):
+		# Keeps event["reply"](msg) working without storing a function in every event
+		if key == "reply":
+			return self.reply
+		raise KeyError(key)
+
+	def _delivered(self):
+		# Tell the connection how long it's been since this was read off the socket
+		stamp = getattr(self, "_stamp", None)
+		conn = self.get("room", self.get("pms"))
+		if stamp is not None and conn is not None:
+			conn._delivered(time.monotonic() - stamp)
+
+class eventqueue:
+	DROP_OLDEST = "drop_oldest"
+	DROP_TYPES = "drop_types"
+	BLOCK = "block"
+
+	def __init__(self, maxsize=0, policy=DROP_OLDEST, drop_types=("login", "logout", "nickchange")):
+		'''Holds events until they're picked up. With a maxsize, what
+		happens once it's full depends on the policy:
+
+		DROP_OLDEST - throw away the oldest event
+		DROP_TYPES - throw away events of the types in drop_types first,
+			the oldest event if there aren't any
+		BLOCK - make the reader wait until there's room, which stops
+			reading from the socket (and, on an engine, every socket)'''
+		self._events = collections.deque()
+		self._lock = threading.Lock()
+		self._not_empty = threading.Condition(self._lock)
+		self._not_full = threading.Condition(self._lock)
+		self.dropped = 0
+		self.set_limit(maxsize, policy, drop_types)
+
+	def __len__(self):
+		return len(self._events)
+
+	def qsize(self):
+		return len(self._events)
+
+	def empty(self):
+		return not self._events
+
+	def set_limit(self, maxsize=0, policy=DROP_OLDEST, drop_types=("login", "logout", "nickchange")):
+		'''Change the maximum size (0 for none) and the overflow policy.'''
+		if policy not in (self.DROP_OLDEST, self.DROP_TYPES, self.BLOCK):
+			raise ValueError("unknown policy %r" % policy)
+		with self._lock:
+			self._maxsize = int(maxsize)
+			self._policy = policy
+			self._drop_types = frozenset(drop_types)
+			self._not_full.notify_all()
+
+	def put(self, event):
+		'''Add an event, making room for it according to the policy.'''
+		with self._lock:
+			if self._maxsize and len(self._events) >= self._maxsize:
+				if self._policy == self.BLOCK:
+					while self._maxsize and len(self._events) >= self._maxsize:
+						self._not_full.wait()
+				elif self._policy == self.DROP_TYPES and event["event"] in self._drop_types:
+					self.dropped += 1
+					return
+				else:
+					self._make_room()
+			self._events.append(event)
+			self._not_empty.notify()
+
+	def get(self, timeout=None):
+		'''Wait for the next event. Raises queue.Empty if timeout
+		seconds pass without one.'''
+		with self._lock:
+			if not self._not_empty.wait_for(lambda: self._events, timeout):
+				raise queue.Empty
+			event = self._events.popleft()
+			self._not_full.notify()
+		event._delivered()
+		return event
+
+	def get_events(self, max_n=100, timeout=None):
+		'''Wait for at least one event, then return a list of up to
+		max_n of them. Returns an empty list if timeout seconds pass
+		without any.'''
+		with self._lock:
+			if not self._not_empty.wait_for(lambda: self._events, timeout):
+				return []
+			events = []
+			while self._events and len(events) < max_n:
+				events.append(self._events.popleft())
+			self._not_full.notify_all()
+		for event in events:
+			event._delivered()
+		return events
+
+	def _make_room(self):
+		while len(self._events) >= self._maxsize:
+			if self._policy == self.DROP_TYPES:
+				for event in self._events:
+					if event["event"] in self._drop_types:
+						self._events.remove(event)
+						break
+				else:
+					self._events.popleft()
+			else:
+				self._events.popleft()
+			self.dropped += 1
+
+# ----------------------------------------------
+# Chatroom history, indexed by mid and by person
+# ----------------------------------------------
+
+class chhistory:
+	def __init__(self, limit=100):
+		'''Holds the last limit messages of a chatroom, oldest first.
+		Messages can be looked up by mid, username or uid without going
+		through all of them, and the oldest ones are dropped (and
+		unindexed) as new ones come in.'''
+		self._msgs = collections.deque()
+		self._times = collections.deque()
+		self._by_mid = {}
+		self._by_name = {}
+		self._by_uid = {}
+		self._limit = limit
+
+	def __len__(self):
+		return len(self._msgs)
+
+	def __iter__(self):
+		return iter(list(self._msgs))
+
+	def __contains__(self, mid):
+		return mid in self._by_mid
+
+	def add(self, msg):
+		'''Add a message, keeping everything ordered by posttime. Returns
+		False if a message with the same mid is already there.'''
+		if msg.mid is not None and msg.mid in self._by_mid:
+			return False
+		posttime = msg.posttime
+		if not self._times or posttime >= self._times[-1]:
+			self._msgs.append(msg)
+			self._times.append(posttime)
+		elif posttime < self._times[0]:
+			self._msgs.appendleft(msg)
+			self._times.appendleft(posttime)
+		else:
+			x = bisect.bisect_right(self._times, posttime)
+			self._msgs.insert(x, msg)
+			self._times.insert(x, posttime)
+		self._index(msg)
+		while len(self._msgs) > self._limit:
+			self._times.popleft()
+			self._unindex(self._msgs.popleft())
+		return True
+
+	def remove(self, msg):
+		'''Take a message out of the history.'''
+		if msg not in self._by_uid.get(msg.user.uid, ()):
+			return
+		x = bisect.bisect_left(self._times, msg.posttime)
+		while self._msgs[x] is not msg:
+			x += 1
+		del self._msgs[x]
+		del self._times[x]
+		self._unindex(msg)
+
+	def get(self, mid):
+		'''Returns the message with the given mid, or None.'''
+		return self._by_mid.get(mid)
+
+	def by_username(self, username):
+		'''Returns every message posted under a (non anon) username.'''
+		return sorted(self._by_name.get(username.lower(), ()), key=_posttime)
+
+	def by_uid(self, uid):
+		'''Returns every message posted by a uid.'''
+		return sorted(self._by_uid.get(uid, ()), key=_posttime)
+
+	def set_limit(self, limit):
+		'''Change how many messages are kept, dropping the oldest if need be.'''
+		self._limit = limit
+		while len(self._msgs) > self._limit:
+			self._times.popleft()
+			self._unindex(self._msgs.popleft())
+
+	def clear(self):
+		'''Forget every message.'''
+		self._msgs.clear()
+		self._times.clear()
+		self._by_mid.clear()
+		self._by_name.clear()
+		self._by_uid.clear()
+
+	def _index(self, msg):
+		if msg.mid is not None:
+			self._by_mid[msg.mid] = msg
+		if msg.user.type != chuser.ANON:
+			self._by_name.setdefault(msg.user.username, {})[msg] = None
+		self._by_uid.setdefault(msg.user.uid, {})[msg] = None
+
+	def _unindex(self, msg):
+		if msg.mid is not None and self._by_mid.get(msg.mid) is msg:
+			del self._by_mid[msg.mid]
+		for index, key in ((self._by_name, msg.user.username), (self._by_uid, msg.user.uid)):
+			msgs = index.get(key)
+			if msgs is not None:
+				msgs.pop(msg, None)
+				if not msgs:
+					del index[key]
+
+# -------------------------------------------------------
+# Online users of a chatroom, indexed by session and name
+# -------------------------------------------------------
+
+class chparticipants:
+	ALL = "all"
+	REGISTERED = "registered"
+	COUNTS = "counts"
+
+	def __init__(self, mode=REGISTERED):
+		'''Holds the users currently in a chatroom. Joins, leaves, renames
+		and lookups by session, username or uid don't go through the
+		whole list. Iterating gives a snapshot, so it's safe while users
+		come and go. What's kept depends on the mode:
+
+		ALL - a chuser for everyone
+		REGISTERED - a chuser for registered users only
+		COUNTS - no chusers at all
+
+		Everyone is counted, by type, whatever the mode. Sessions without
+		a chuser still have their type and name (if not anon) kept, so
+		there's enough to say who someone was when they change names.'''
+		self._types = {}
+		self._names = {}
+		self._counts = [0, 0, 0]
+		self._by_session = {}
+		self._by_name = {}
+		self._by_uid = {}
+		self.set_mode(mode)
+
+	def __len__(self):
+		return len(self._types)
+
+	def __iter__(self):
+		return iter(self.snapshot())
+
+	def __contains__(self, session):
+		return session in self._types
+
+	def set_mode(self, mode):
+		'''Change what's kept. Users the new mode doesn't keep are let go
+		of, but stay counted.'''
+		if mode not in (self.ALL, self.REGISTERED, self.COUNTS):
+			raise ValueError("unknown mode %r" % mode)
+		self.mode = mode
+		for user in self.snapshot():
+			if not self._keeps(user.type):
+				self._unindex(user.session)
+				if user.type != chuser.ANON:
+					self._names[user.session] = user.username
+
+	def count(self, type=None):
+		'''How many sessions are online, of one type or all together.'''
+		if type is None:
+			return len(self._types)
+		return self._counts[type]
+
+	def type_of(self, session):
+		'''Returns the type of the user with the given session, or None.'''
+		return self._types.get(session)
+
+	def name_of(self, session):
+		'''Returns the name of the user with the given session, whether or
+		not a chuser is kept for them, or None if they're anon or offline.'''
+		user = self._by_session.get(session)
+		if user is not None:
+			return None if user.type == chuser.ANON else user.username
+		return self._names.get(session)
+
+	def snapshot(self):
+		'''Returns a list of everyone who's online.'''
+		return list(self._by_session.values())
+
+	def add(self, user):
+		'''Add a user, replacing whoever had the same session. Only
+		counted if the mode doesn't keep users of its type.'''
+		if not self._keeps(user.type):
+			self.add_session(user.session, user.type, None if user.type == chuser.ANON else user.username)
+			return
+		self.remove(user.session)
+		self._types[user.session] = user.type
+		self._counts[user.type] += 1
+		self._by_session[user.session] = user
+		if user.type != chuser.ANON:
+			self._by_name.setdefault(user.username, {})[user.session] = user
+		self._by_uid.setdefault(user.uid, {})[user.session] = user
+
+	def add_session(self, session, type, username=None):
+		'''Count a session without keeping a chuser for it, only its type
+		and username.'''
+		self.remove(session)
+		self._types[session] = type
+		self._counts[type] += 1
+		if username:
+			self._names[session] = username
+
+	def remove(self, session):
+		'''Remove the session, returning its chuser if one was kept,
+		else None.'''
+		type = self._types.pop(session, None)
+		if type is None:
+			return None
+		self._counts[type] -= 1
+		self._names.pop(session, None)
+		return self._unindex(session)
+
+	def rename(self, session, user):
+		'''Swap the user behind a session for a new one, returning the
+		old one (or None if the session wasn't online or wasn't kept).'''
+		online = session in self._types
+		old = self.remove(session)
+		if online:
+			self.add(user)
+		return old
+
+	def get(self, session):
+		'''Returns the user with the given session, or None.'''
+		return self._by_session.get(session)
+
+	def by_username(self, username):
+		'''Returns every session logged in under a (non anon) username.'''
+		return list(self._by_name.get(username.lower(), {}).values())
+
+	def by_uid(self, uid):
+		'''Returns every session with the given uid.'''
+		return list(self._by_uid.get(uid, {}).values())
+
+	def is_online(self, username, type=chuser.REGD):
+		'''Whether or not someone of the given type is logged in under username.'''
+		for user in self._by_name.get(username.lower(), {}).values():
+			if user.type == type:
+				return True
+		return False
+
+	def clear(self):
+		'''Forget everyone.'''
+		self._types.clear()
+		self._names.clear()
+		self._counts = [0, 0, 0]
+		self._by_session.clear()
+		self._by_name.clear()
+		self._by_uid.clear()
+
+	def _keeps(self, type):
+		return self.mode == self.ALL or self.mode == self.REGISTERED and type == chuser.REGD
+
+	def _unindex(self, session):
+		user = self._by_session.pop(session, None)
+		if user is not None:
+			for index, key in ((self._by_name, user.username), (self._by_uid, user.uid)):
+				users = index.get(key)
+				if users is not None:
+					users.pop(session, None)
+					if not users:
+						del index[key]
+		return user
+
+# ---------------------------------------------
+# Rules deciding which new messages are ignored
+# ---------------------------------------------
+
+class msgfilter:
+	def __init__(self):
+		'''Decides which new messages a chatroom ignores, from a list of
+		declarative rules rather than a function per rule. Rules are
+		compiled so each message costs a few set lookups and at most one
+		combined regex search, which rules out every content rule at
+		once when nothing matches; just the rules that could still
+		match get looked at one by one.
+		Hits, and how long each rule takes if time_rules() is on, are
+		counted per rule, see stats(). A filter can be shared between
+		rooms with chatroom.set_filter().
+
+		Ex: f = msgfilter(); f.add("anon links", user_type=chuser.ANON, pattern="https?://")'''
+		self._rules = {}
+		self._order = 0
+		self._compiled = None
+		self._timed = False
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self._rules)
+
+	def __contains__(self, name):
+		return name in self._rules
+
+	def add(self, name, user_type=None, usernames=None, uids=None, ips=None, words=None, pattern=None, rate=None, func=None):
+		'''Add a rule, replacing any with the same name. A message
+		matches it when it matches every condition given:
+
+		user_type - a chuser type, or a list of them
+		usernames - usernames, in any case
+		uids, ips - uids and ips
+		words - any of these words in the content, in any case
+		pattern - a regex (string or compiled) found in the content
+		rate - (count, seconds): the poster has posted more than count
+			messages matching the rest of the rule within seconds
+		func - func(msg) returns True, for anything else'''
+		if user_type is not None:
+			user_type = frozenset([user_type] if isinstance(user_type, int) else user_type)
+		if usernames is not None:
+			usernames = frozenset(x.lower() for x in usernames)
+		if uids is not None:
+			uids = frozenset(int(x) for x in uids)
+		if ips is not None:
+			ips = frozenset(ips)
+		words = [x for x in words or () if x] or None
+		if pattern is not None and isinstance(pattern, str):
+			pattern = re.compile(pattern)
+		with self._lock:
+			old = self._rules.get(name)
+			self._order += 1
+			self._rules[name] = _filterrule(name, old.order if old else self._order, user_type, usernames, uids, ips, words, pattern, rate, func)
+			self._compiled = None
+
+	def remove(self, name):
+		'''Remove a rule, if there is one by that name.'''
+		with self._lock:
+			if self._rules.pop(name, None):
+				self._compiled = None
+
+	def rules(self):
+		'''Returns the names of the rules, in the order they're tried.'''
+		return [x.name for x in sorted(self._rules.values(), key=_filterorder)]
+
+	def match(self, msg):
+		'''Returns the name of the first rule msg matches, or None.'''
+		compiled = self._compiled or self._compile()
+		by_name, by_uid, by_ip, by_type, patterned, general, prefilter = compiled
+		user = msg.user
+		candidates = []
+		if by_name and user.type != chuser.ANON:
+			candidates.extend(by_name.get(user.username, ()))
+		if by_uid:
+			candidates.extend(by_uid.get(user.uid, ()))
+		if by_ip:
+			candidates.extend(by_ip.get(user.ip, ()))
+		if by_type:
+			candidates.extend(by_type.get(user.type, ()))
+		# Whether any rule's words or pattern could be in the content, only worked out if it matters
+		content = None
+		if patterned:
+			content = _filtercontent(prefilter, msg)
+			if content:
+				candidates.extend(patterned)
+		candidates.extend(general)
+		if len(candidates) > 1:
+			candidates.sort(key=_filterorder)
+		timed = self._timed
+		for rule in candidates:
+			if rule.prefiltered:
+				if content is None:
+					content = _filtercontent(prefilter, msg)
+				if not content:
+					continue
+			if timed:
+				start = time.perf_counter()
+				hit = rule.match(msg)
+				rule.time += time.perf_counter() - start
+			else:
+				hit = rule.match(msg)
+			rule.checks += 1
+			if hit:
+				rule.hits += 1
+				return rule.name
+		return None
+
+	def time_rules(self, value=True):
+		'''Control whether or not the time spent on each rule is
+		recorded, see stats().'''
+		self._timed = bool(value)
+
+	def stats(self):
+		'''Returns {name: [hits, times checked, seconds spent]} for every
+		rule. Rules ruled out by the lookups or the combined regex aren't
+		checked at all, and don't add to either.'''
+		return dict((x.name, [x.hits, x.checks, x.time]) for x in self._rules.values())
+
+	def reset_stats(self):
+		'''Zero every rule's counters.'''
+		for rule in list(self._rules.values()):
+			rule.hits = rule.checks = 0
+			rule.time = 0.0
+
+	def _compile(self):
+		# Index each rule under its most selective condition, so a message
+		# only gets compared against rules it might match
+		with self._lock:
+			by_name, by_uid, by_ip, by_type = {}, {}, {}, {}
+			patterned, general = [], []
+			for rule in sorted(self._rules.values(), key=_filterorder):
+				for index, keys in ((by_name, rule.usernames), (by_uid, rule.uids), (by_ip, rule.ips), (by_type, rule.types)):
+					if keys is not None:
+						for key in keys:
+							index.setdefault(key, []).append(rule)
+						break
+				else:
+					(patterned if rule.prefiltered else general).append(rule)
+			# Every rule's words merged into one trie, and every pattern into
+			# one alternation, so a message is searched twice at most
+			prefilter = [_word_pattern([x for rule in self._rules.values() for x in rule.words or ()])]
+			patterns = [rule.pattern for rule in self._rules.values() if rule.pattern is not None and rule.prefiltered]
+			if patterns:
+				try:
+					prefilter.append(re.compile("|".join(_scoped_pattern(x) for x in patterns)))
+				except re.error:
+					# Something in there can't be combined, so nothing can be ruled out
+					prefilter = None
+			if prefilter is not None:
+				prefilter = [x for x in prefilter if x]
+			self._compiled = (by_name, by_uid, by_ip, by_type, patterned, general, prefilter)
+			return self._compiled
+
+class _filterrule:
+	def __init__(self, name, order, types, usernames, uids, ips, words, pattern, rate, func):
+		self.name = name
+		self.order = order
+		self.types = types
+		self.usernames = usernames
+		self.uids = uids
+		self.ips = ips
+		self.words = words
+		self.pattern = pattern
+		self.searches = [x for x in (_word_pattern(words or ()), pattern) if x]
+		# Patterns with groups can't go in the prefilter's alternation, as
+		# it would renumber them and break any backreferences
+		self.prefiltered = bool(self.searches) and (pattern is None or not pattern.groups)
+		self.rate = rate
+		self.func = func
+		self.hits = 0
+		self.checks = 0
+		self.time = 0.0
+		self._posts = {}
+		self._sweep = 0
+
+	def match(self, msg):
+		user = msg.user
+		if self.types is not None and user.type not in self.types:
+			return False
+		if self.usernames is not None and (user.type == chuser.ANON or user.username not in self.usernames):
+			return False
+		if self.uids is not None and user.uid not in self.uids:
+			return False
+		if self.ips is not None and user.ip not in self.ips:
+			return False
+		if self.searches:
+			content = msg.content or ""
+			for check in self.searches:
+				if not check.search(content):
+					return False
+		if self.func is not None and not self.func(msg):
+			return False
+		if self.rate is not None:
+			return self._over_rate(user.uid)
+		return True
+
+	def _over_rate(self, uid):
+		# A deque of the last count + 1 post times per uid; over the rate
+		# if it's full and they all fall within the window
+		count, seconds = self.rate
+		now = time.monotonic()
+		posts = self._posts.get(uid)
+		if posts is None:
+			posts = self._posts[uid] = collections.deque(maxlen=count + 1)
+		posts.append(now)
+		self._sweep += 1
+		if self._sweep >= 10000:
+			self._sweep = 0
+			for key in [x for x, y in self._posts.items() if now - y[-1] > seconds]:
+				del self._posts[key]
+		return len(posts) > count and now - posts[0] <= seconds
+
+# ------------------------------------------------
+# Everyone seen in any room, for the whole process
+# ------------------------------------------------
+
+class chdirectory:
+	def __init__(self, size=100000, ttl=86400):
+		'''Keeps track of the people seen posting or joining in every
+		chatroom, once set_directory() has set it up, so someone can be
+		followed across rooms without going through each room's history.
+		Lookups by uid, umid, ip or username are a dict lookup each, and
+		every one of those remembers which rooms it was seen in and
+		when. At most size people are kept, the least recently seen
+		going first, and anyone not seen for ttl seconds is dropped.
+
+		Ex: set_directory(chdirectory()).rooms(umid=msg.umid, within=3600)'''
+		self.size = size
+		self.ttl = ttl
+		self._entries = collections.OrderedDict()
+		self._indexes = {"uid": {}, "umid": {}, "ip": {}, "username": {}}
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self._entries)
+
+	def see(self, user, room, when=None, umid=None):
+		'''Record that user (a chuser) was seen in room (its name) at
+		when (now, by default), posting with umid if it's known.'''
+		now = time.time()
+		when = now if when is None else float(when)
+		username = user.username if user.type != chuser.ANON else None
+		key = username if user.type == chuser.REGD else user.uid
+		umid = umid or user.umid
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is None:
+				entry = self._entries[key] = chdirentry(user)
+			else:
+				self._entries.move_to_end(key)
+				entry.username = username or entry.username
+				entry.uid = user.uid
+				entry.type = user.type
+			if when >= entry.last_seen:
+				entry.last_seen = when
+				entry.last_room = room
+			if entry.rooms.get(room, 0) < when:
+				entry.rooms[room] = when
+			for name, value in (("uid", user.uid), ("umid", umid), ("ip", user.ip), ("username", username)):
+				if value:
+					getattr(entry, name + "s")[value] = None
+					seen = self._indexes[name].get(value)
+					if seen is None:
+						seen = self._indexes[name][value] = ({}, {})
+					seen[0][key] = None
+					if seen[1].get(room, 0) < when:
+						seen[1][room] = when
+			self._evict(now)
+
+	def find(self, uid=None, umid=None, ip=None, username=None):
+		'''Returns the chdirentry of everyone seen with the given uid,
+		umid, ip or username (give one).'''
+		seen = self._lookup(uid, umid, ip, username)
+		if seen is None:
+			return []
+		with self._lock:
+			return [self._entries[x] for x in seen[0] if x in self._entries]
+
+	def rooms(self, uid=None, umid=None, ip=None, username=None, within=None):
+		'''Returns {room: last seen} for every room the given uid, umid,
+		ip or username (give one) was seen in, only counting the last
+		within seconds if given.'''
+		seen = self._lookup(uid, umid, ip, username)
+		if seen is None:
+			return {}
+		with self._lock:
+			rooms = dict(seen[1])
+		if within is not None:
+			cutoff = time.time() - within
+			rooms = dict((x, y) for x, y in rooms.items() if y >= cutoff)
+		return rooms
+
+	def expire(self):
+		'''Drop everyone not seen for ttl seconds now, rather than as
+		new people are seen.'''
+		if not self.ttl:
+			return
+		cutoff = time.time() - self.ttl
+		with self._lock:
+			for key, entry in [x for x in self._entries.items() if x[1].last_seen < cutoff]:
+				self._drop(key, entry)
+
+	def clear(self):
+		'''Forget everyone.'''
+		with self._lock:
+			self._entries.clear()
+			for index in self._indexes.values():
+				index.clear()
+
+	def _lookup(self, uid, umid, ip, username):
+		given = [(x, y) for x, y in (("uid", uid), ("umid", umid), ("ip", ip), ("username", username)) if y is not None]
+		if len(given) != 1:
+			raise ValueError("give one of uid, umid, ip or username")
+		name, value = given[0]
+		if name == "uid":
+			value = int(value)
+		elif name == "username":
+			value = value.lower()
+		return self._indexes[name].get(value)
+
+	def _evict(self, now):
+		# The least recently seen are at the front; drop them while
+		# there are too many or they've been gone too long
+		entries = self._entries
+		cutoff = now - self.ttl if self.ttl else None
+		while entries:
+			key, entry = next(iter(entries.items()))
+			if len(entries) <= self.size and (cutoff is None or entry.last_seen >= cutoff):
+				break
+			self._drop(key, entry)
+
+	def _drop(self, key, entry):
+		del self._entries[key]
+		values = [("username", x) for x in entry.usernames]
+		values.extend(("uid", x) for x in entry.uids)
+		values.extend(("umid", x) for x in entry.umids)
+		values.extend(("ip", x) for x in entry.ips)
+		for name, value in values:
+			index = self._indexes[name]
+			seen = index.get(value)
+			if seen is not None:
+				seen[0].pop(key, None)
+				if not seen[0]:
+					del index[value]
+
+class chdirentry:
+	__slots__ = ("username", "uid", "type", "usernames", "uids", "umids", "ips", "first_seen", "last_seen", "last_room", "rooms")
+
+	def __init__(self, user):
+		'''What a chdirectory knows about someone: their latest username,
+		uid and type, every username, uid, umid and ip they've been seen
+		with, and {room: last seen} for every room they've been seen in.'''
+		self.username = user.username if user.type != chuser.ANON else ""
+		self.uid = user.uid
+		self.type = user.type
+		self.usernames = {}
+		self.uids = {}
+		self.umids = {}
+		self.ips = {}
+		self.first_seen = time.time()
+		self.last_seen = 0.0
+		self.last_room = None
+		self.rooms = {}
+
+# -------------------------------------------------
+# Flood and duplicate detection across every room
+# -------------------------------------------------
+
+class flooddetector:
+	RATE = "rate"
+	DUPLICATE = "duplicate"
+
+	def __init__(self, window=60, rate=20, duplicates=3, similarity=0.5, shingle=2, sketch=16, min_length=20, max_keys=100000):
+		'''Watches new messages in every chatroom, once set with
+		set_flood_detector(), for two kinds of flood, each within a
+		sliding window of window seconds:
+
+		RATE - one uid or umid posting more than rate messages
+		DUPLICATE - duplicates posts of the same text, or of text at
+			least similarity alike, by anyone in any rooms
+
+		Text is compared lowercased with whitespace collapsed, and only
+		if it's at least min_length long. Exact copies are found by
+		hash. For near copies, each message gets a MinHash sketch:
+		the sketch smallest hashes of its runs of shingle words. Pairs
+		of its smallest three point at the group of messages it's
+		likely to belong to. Every group, uid and umid holds no more
+		than the posts needed to trigger, and at most max_keys of each
+		are kept, the least recently seen going first, so memory
+		doesn't grow with traffic. A chatroom seeing a flood emits a
+		"flood" event (see check()). rate, duplicates or similarity can
+		be None to turn that check off.
+
+		Ex: set_flood_detector(flooddetector(window=30, duplicates=4))'''
+		self.window = window
+		self.rate = rate
+		self.duplicates = duplicates
+		self.similarity = similarity
+		self.shingle = max(1, shingle)
+		self._shifts = [slice(x, None) for x in range(self.shingle)]
+		self.sketch = sketch
+		self.min_length = min_length
+		self.max_keys = max_keys
+		self.floods = 0
+		self.checked = 0
+		self._posters = collections.OrderedDict()
+		self._texts = collections.OrderedDict()
+		self._bands = collections.OrderedDict()
+		self._lock = threading.Lock()
+
+	def check(self, msg, room):
+		'''Record a new chmessage posted in room (a name), returning a
+		list of (kind, posts) for every flood it completes, where posts
+		are the (posttime, chuser, mid, room) behind it. Empty if none.'''
+		when = time.time() if msg.posttime is None else msg.posttime
+		user = msg.user
+		post = (when, user, msg.mid, room)
+		floods = []
+		with self._lock:
+			self.checked += 1
+			if self.rate:
+				posters = self._posters
+				windows = []
+				fired = None
+				for key in (user.uid, msg.umid or user.umid):
+					if key:
+						posts = posters.get(key)
+						if posts is None:
+							posts = posters[key] = []
+							if len(posters) > self.max_keys:
+								posters.popitem(False)
+						else:
+							posters.move_to_end(key)
+						windows.append(posts)
+						if self._add(posts, post, self.rate + 1) and fired is None:
+							fired = posts
+				if fired is not None:
+					# Once is enough when the uid and umid both trip it
+					floods.append((self.RATE, list(fired)))
+					for posts in windows:
+						posts.clear()
+			if self.duplicates:
+				words = msg.content.lower().split() if msg.content else []
+				text = " ".join(words)
+				if len(text) >= self.min_length:
+					group = self._group(text, words)
+					if self._add(group, post, self.duplicates):
+						floods.append((self.DUPLICATE, list(group)))
+						group.clear()
+			self.floods += len(floods)
+		return floods
+
+	def stats(self):
+		'''Returns how many messages were checked and floods found, and
+		how many posters and texts are being tracked.'''
+		return {
+			"checked": self.checked,
+			"floods": self.floods,
+			"posters": len(self._posters),
+			"texts": len(self._texts),
+		}
+
+	def clear(self):
+		'''Forget everything seen so far.'''
+		with self._lock:
+			self._posters.clear()
+			self._texts.clear()
+			self._bands.clear()
+
+	def _add(self, posts, post, count):
+		# Add a post to a window of the last count posts, returning
+		# whether it's now full and all within window seconds
+		posts.append(post)
+		if len(posts) > count:
+			del posts[0]
+		return len(posts) == count and post[0] - posts[0][0] <= self.window
+
+	def _group(self, text, words):
+		# The group of duplicates a text belongs to: the one of an exact
+		# copy, else of a similar enough text, else a new one
+		key = hash(text)
+		texts = self._texts
+		group = texts.get(key)
+		if group is not None:
+			texts.move_to_end(key)
+			return group
+		if self.similarity:
+			if len(words) > self.shingle:
+				# Repeats are left in; they only matter for text that repeats itself
+				hashes = sorted(map(hash, zip(*map(words.__getitem__, self._shifts))))
+				del hashes[self.sketch:]
+			else:
+				hashes = [key]
+			# Any two of the three smallest in common is a likely match;
+			# one alone isn't, since the smallest are the common ones
+			if len(hashes) > 2:
+				a, b, c = hashes[:3]
+				bands = (hash((a, b)), hash((a, c)), hash((b, c)))
+			else:
+				bands = (hash(tuple(hashes)),)
+			table = self._bands
+			group = tried = sketch = None
+			for band in bands:
+				found = table.get(band)
+				if found is not None and found is not tried:
+					if sketch is None:
+						sketch = frozenset(hashes)
+					if _sketch_similarity(sketch, found.sketch, self.sketch, self.similarity):
+						group = found
+						break
+					tried = found
+			if group is None:
+				group = _floodgroup()
+				group.sketch = tuple(hashes)
+			for band in bands:
+				table[band] = group
+			while len(table) > self.max_keys * 3:
+				table.popitem(False)
+		else:
+			group = _floodgroup()
+		texts[key] = group
+		if len(texts) > self.max_keys:
+			texts.popitem(False)
+		return group
+
+class _floodgroup(list):
+	# The posts of a group of duplicates, and the sketch of its first text
+	__slots__ = ("sketch",)
+
+# ----------------------------------------------
+# On disk message archive, one directory a room
+# ----------------------------------------------
+
+class archive:
+	def __init__(self, path, segment_size=64 * 1024 * 1024):
+		'''Keeps every message a chatroom sees on disk, for as long as
+		you like. Each room gets a directory of append only segments:
+		a .log file of binary records, and an .idx file with one fixed
+		size entry per record holding its posttime, offset and hashes
+		of its mid and username. Queries go through the memory mapped
+		.idx files, and only read the records that match, so they
+		don't pull whole segments into memory. A new segment is started
+		once the current one is segment_size bytes.
+
+		Ex: room.set_archive(archive("logs"))'''
+		self.path = path
+		self.segment_size = segment_size
+		self._rooms = {}
+		self._lock = threading.Lock()
+		os.makedirs(path, exist_ok=True)
+
+	def write(self, room, msg):
+		'''Append a chmessage to a room's archive. Messages whose mid was
+		archived recently (history that's replayed on login) are skipped.'''
+		self._room(room).write(msg)
+
+	def query(self, room, username=None, start=None, end=None, mid=None, limit=None):
+		'''Yield the archived chmessages of a room, in the order they were
+		archived, optionally only those posted under username, between
+		the start and end posttimes, or with the given mid.
+
+		Ex: archive.query("room", "someone", time.time() - 86400)'''
+		archived = self._room(room, False)
+		if archived is None:
+			return iter(())
+		return archived.query(username, start, end, mid, limit)
+
+	def get(self, room, mid, start=None, end=None):
+		'''Returns the archived chmessage with the given mid, or None.
+		Giving a rough start and end posttime makes it quicker.'''
+		for msg in self.query(room, start=start, end=end, mid=mid, limit=1):
+			return msg
+		return None
+
+	def flush(self):
+		'''Push everything written so far out to the files.'''
+		for room in list(self._rooms.values()):
+			room.flush()
+
+	def close(self):
+		'''Flush and close every room's files.'''
+		with self._lock:
+			for room in self._rooms.values():
+				room.close()
+			self._rooms.clear()
+
+	def _room(self, name, create=True):
+		# Only writing makes a room's directory; reading one that was
+		# never archived gives None rather than leaving empty files open
+		name = name.lower()
+		room = self._rooms.get(name)
+		if room is None:
+			path = os.path.join(self.path, name)
+			if not create and not os.path.isdir(path):
+				return None
+			with self._lock:
+				room = self._rooms.get(name)
+				if room is None:
+					room = self._rooms[name] = _archiveroom(path, self.segment_size)
+		return room
+
+class _archiveroom:
+	def __init__(self, path, segment_size):
+		self._path = path
+		self._segment_size = segment_size
+		self._lock = threading.Lock()
+		self._log = None
+		self._idx = None
+		self._recent = collections.OrderedDict()
+		os.makedirs(path, exist_ok=True)
+		# [number, lowest posttime, highest posttime, most out of order]
+		self._segments = []
+		for name in sorted(os.listdir(path)):
+			if name.endswith(".idx"):
+				self._segments.append(self._load_segment(int(name[:-4])))
+		if not self._segments:
+			self._segments.append([0, None, None, 0.0])
+		self._open(self._segments[-1])
+
+	def write(self, msg):
+		mid = _to_str(msg.mid if msg.mid is not None else "").encode()
+		mid_hash = _archive_hash(mid)
+		username = "" if msg.user.type == chuser.ANON else msg.user.username
+		name = username.encode()
+		umid = _to_str(msg.umid or msg.user.umid or "").encode()
+		ip = _to_str(msg.user.ip or "").encode()
+		formatted = _to_str(msg.formatted or "").encode()
+		posttime = float(msg.posttime)
+		with self._lock:
+			if mid and mid_hash in self._recent:
+				return
+			segment = self._segments[-1]
+			if self._size >= self._segment_size:
+				segment = self._roll()
+			self._top = posttime if self._top is None else max(self._top, posttime)
+			if segment[1] is None or posttime < segment[1]:
+				segment[1] = posttime
+			if segment[2] is None or posttime > segment[2]:
+				segment[2] = posttime
+			segment[3] = max(segment[3], self._top - posttime)
+			record = _archive_record.pack(posttime, msg.user.type or 0, msg.user.uid or 0, len(mid), len(name), len(umid), len(ip), len(formatted))
+			self._log.write(record + mid + name + umid + ip + formatted)
+			self._idx.write(_archive_entry.pack(posttime, self._top, self._size, mid_hash, _archive_hash(name)))
+			self._size += len(record) + len(mid) + len(name) + len(umid) + len(ip) + len(formatted)
+			self._remember(mid_hash)
+
+	def query(self, username, start, end, mid, limit):
+		with self._lock:
+			self._log.flush()
+			self._idx.flush()
+			segments = [list(x) for x in self._segments]
+		name = None if username is None else username.lower()
+		name_hash = None if name is None else _archive_hash(name.encode())
+		mid = None if mid is None else _to_str(mid)
+		mid_hash = None if mid is None else _archive_hash(mid.encode())
+		found = 0
+		for number, low, high, skew in segments:
+			if low is None or (start is not None and high < start) or (end is not None and low > end):
+				continue
+			for msg in self._scan(number, skew, name_hash, start, end, mid_hash):
+				if (name is None or msg.user.username == name) and (mid is None or msg.mid == mid):
+					yield msg
+					found += 1
+					if limit and found >= limit:
+						return
+
+	def flush(self):
+		with self._lock:
+			self._log.flush()
+			self._idx.flush()
+
+	def close(self):
+		with self._lock:
+			self._log.close()
+			self._idx.close()
+
+	def _scan(self, number, skew, name_hash, start, end, mid_hash):
+		log_map, idx_map = _map(self._file(number, ".log")), _map(self._file(number, ".idx"))
+		if log_map is None or idx_map is None:
+			return
+		try:
+			size = _archive_entry.size
+			entries = len(idx_map) // size
+			first = 0
+			if start is not None:
+				# The highest posttime so far only goes up, so it can be bisected
+				first = bisect.bisect_left(_archivetops(idx_map, entries), start)
+			stop = None if end is None else end + skew
+			view = memoryview(idx_map)[first * size:entries * size]
+			try:
+				for posttime, top, offset, entry_mid, entry_name in _archive_entry.iter_unpack(view):
+					if stop is not None and top > stop:
+						break
+					if start is not None and posttime < start or end is not None and posttime > end:
+						continue
+					if name_hash is not None and entry_name != name_hash or mid_hash is not None and entry_mid != mid_hash:
+						continue
+					if offset + _archive_record.size > len(log_map):
+						# Not flushed yet when the query started
+						break
+					yield _archive_read(log_map, offset)
+			finally:
+				view.release()
+		finally:
+			log_map.close()
+			idx_map.close()
+
+	def _file(self, number, ext):
+		return os.path.join(self._path, "%08i%s" % (number, ext))
+
+	def _load_segment(self, number):
+		segment = [number, None, None, 0.0]
+		meta = self._file(number, ".meta")
+		if os.path.exists(meta):
+			with open(meta) as f:
+				low, high, skew = f.read().split()
+			segment[1:] = [float(low), float(high), float(skew)]
+			return segment
+		# Only the segment being written to has no .meta, so go through its index
+		idx_map = _map(self._file(number, ".idx"))
+		if idx_map is not None:
+			view = memoryview(idx_map)[:len(idx_map) // _archive_entry.size * _archive_entry.size]
+			for posttime, top, offset, entry_mid, entry_name in _archive_entry.iter_unpack(view):
+				segment[1] = posttime if segment[1] is None else min(segment[1], posttime)
+				segment[2] = posttime if segment[2] is None else max(segment[2], posttime)
+				segment[3] = max(segment[3], top - posttime)
+			view.release()
+			idx_map.close()
+		return segment
+
+	def _open(self, segment):
+		self._log = open(self._file(segment[0], ".log"), "ab")
+		self._idx = open(self._file(segment[0], ".idx"), "ab")
+		self._size = self._log.tell()
+		# Drop any half written index entry left by a crash
+		entries = self._idx.tell() // _archive_entry.size
+		self._idx.truncate(entries * _archive_entry.size)
+		self._top = segment[2]
+		idx_map = _map(self._file(segment[0], ".idx"))
+		if idx_map is not None:
+			with idx_map:
+				for x in range(max(0, entries - _ARCHIVE_RECENT), entries):
+					self._remember(_archive_entry.unpack_from(idx_map, x * _archive_entry.size)[3])
+
+	def _roll(self):
+		# Seal the current segment and start the next one
+		segment = self._segments[-1]
+		self._log.close()
+		self._idx.close()
+		with open(self._file(segment[0], ".meta"), "w") as f:
+			f.write("%r %r %r" % (segment[1], segment[2], segment[3]))
+		segment = [segment[0] + 1, None, None, 0.0]
+		self._segments.append(segment)
+		self._open(segment)
+		return segment
+
+	def _remember(self, mid_hash):
+		self._recent[mid_hash] = None
+		if len(self._recent) > _ARCHIVE_RECENT:
+			self._recent.popitem(False)
+
+class _archivetops:
+	# Lets bisect look at the running highest posttime of each index entry
+	def __init__(self, idx_map, entries):
+		self._map = idx_map
+		self._entries = entries
+
+	def __len__(self):
+		return self._entries
+
+	def __getitem__(self, x):
+		return _archive_top.unpack_from(self._map, x * _archive_entry.size + 8)[0]
+
+# ---------------------------------------------
+# Incremental decoder for NUL terminated frames
+# ---------------------------------------------
+
+class framedecoder:
+	def __init__(self, size=65536):
+		'''Splits the byte stream coming off a socket into frames.
+		Bytes are read straight into a preallocated buffer and a read
+		cursor walks over it, so every complete frame in a read is found
+		in one pass without copying or rejoining what's left over.'''
+		self._buf = bytearray(size)
+		self._view = memoryview(self._buf)
+		self._start = 0
+		self._end = 0
+		self.record = None
+
+	def __len__(self):
+		return self._end - self._start
+
+	def recv_into(self, sock):
+		'''Read whatever's available from sock into the buffer. Returns
+		the number of bytes read, 0 meaning the other end hung up.'''
+		if self._end == len(self._buf):
+			self._make_room(1)
+		read = sock.recv_into(self._view[self._end:])
+		if self.record and read:
+			self.record.write(self._view[self._end:self._end + read])
+		self._end += read
+		return read
+
+	def feed(self, data):
+		'''Add bytes that were read some other way.'''
+		if self._end + len(data) > len(self._buf):
+			self._make_room(len(data))
+		self._view[self._end:self._end + len(data)] = data
+		if self.record and data:
+			self.record.write(data)
+		self._end += len(data)
+
+	def frames(self):
+		'''Yield every complete frame in the buffer as a string, with
+		line breaks stripped and empty frames skipped.'''
+		buf = self._buf
+		start = self._start
+		while True:
+			nul = buf.find(b'\x00', start, self._end)
+			if nul < 0:
+				break
+			end = nul
+			while end > start and buf[end - 1] in b'\r\n':
+				end -= 1
+			while start < end and buf[start] in b'\r\n':
+				start += 1
+			self._start = nul + 1
+			if start != end:
+				yield str(self._view[start:end], "utf-8", "replace")
+			start = self._start
+		if self._start == self._end:
+			self._start = self._end = 0
+
+	def clear(self):
+		'''Throw away anything left in the buffer.'''
+		self._start = self._end = 0
+
+	def _make_room(self, needed):
+		# Slide the unread bytes to the front, growing the buffer if that isn't enough
+		left = self._end - self._start
+		if left + needed > len(self._buf):
+			size = len(self._buf)
+			while left + needed > size:
+				size *= 2
+			self._view.release()
+			self._buf.extend(bytes(size - len(self._buf)))
+			self._view = memoryview(self._buf)
+		self._view[:left] = self._view[self._start:self._end]
+		self._start, self._end = 0, left
+
+# -------------------------------------------
+# Socket plumbing shared by PMs and chatrooms
+# -------------------------------------------
+
+class _connection:
+	_raw_commands = frozenset()
+	
+	def __init__(self, engine=None, events=None):
+		self._engine = engine
+		self._decoder = framedecoder()
+		self._frames = collections.deque()
+		self._outbuf = bytearray()
+		self._writer = sendqueue()
+		self._flushing = threading.Lock()
+		self._flush_timer = None
+		self._session = None
+		self._reconnects = 0
+		self._inited = threading.Event()
+		self._handlers = dict(self._commands)
+		self._command_stats = None
+		self._q = events if events is not None else eventqueue()
+		self._frames_in = 0
+		self._bytes_in = 0
+		self._frames_out = 0
+		self._bytes_out = 0
+		self._read_time = None
+		self._delivery = [0, 0.0, 0.0]
+		self._metrics_mark = (time.monotonic(), 0, 0, 0, 0)
+	
+	# ---------------------
+	 # Event queue methods
+	
+	def get_events(self, max_n=100, timeout=None):
+		'''Wait for events, then return a list of up to max_n of them
+		at once. Returns an empty list if timeout seconds pass first.'''
+		if not self._connected:
+			raise NotConnected
+		return self._q.get_events(max_n, timeout)
+	
+	def limit_events(self, maxsize, policy=eventqueue.DROP_OLDEST, drop_types=("login", "logout", "nickchange")):
+		'''Control the number of events left waiting to be picked up, and
+		what to do once there are that many. See eventqueue.'''
+		self._q.set_limit(maxsize, policy, drop_types)
+	
+	def limit_sends(self, rate=None, burst=None):
+		'''Control how many frames a second can be sent on this
+		connection (None for no limit), letting bursts of up to burst
+		frames through. Frames over the limit wait their turn.'''
+		self._writer.limit = ratelimit(rate, burst) if rate else None
+	
+	def send_stats(self):
+		'''Returns how many frames are waiting to be sent, how many have
+		been sent in how many writes, and the average and worst time
+		(in seconds) frames waited.'''
+		return self._writer.stats()
+	
+	# ------------------------
+	 # Protocol handler methods
+	
+	def record(self, f):
+		'''Write every byte read from chatango to the binary file f
+		(None to stop), so the stream can be replayed later.
+		
+		Ex: room.record(open("capture.bin", "wb"))'''
+		self._decoder.record = f
+	
+	def register_command(self, command, func):
+		'''Handle a raw command from chatango with func(self, args), where
+		args are the colon separated fields after the command. This can
+		add commands the library doesn't know about, or replace the
+		built in handling of ones it does.
+		
+		Ex: room.register_command("climited", lambda room, args: print("slow down"))'''
+		self._handlers[command] = func
+	
+	def unregister_command(self, command):
+		'''Go back to the built in handling of a command, if there is any.'''
+		if command in self._commands:
+			self._handlers[command] = self._commands[command]
+		else:
+			self._handlers.pop(command, None)
+	
+	def time_commands(self, value=True):
+		'''Control whether or not the time spent handling each
+		command is recorded, see command_stats().'''
+		self._command_stats = {} if value else None
+	
+	def command_stats(self):
+		'''Returns {command: [count, total seconds]} for every command
+		handled since time_commands() was turned on.'''
+		return dict((x, list(y)) for x, y in (self._command_stats or {}).items())
+	
+	def metrics(self):
+		'''Returns a snapshot of how busy the connection is: frames and
+		bytes read and sent, in total and per second since the last
+		call, events and frames waiting, the average and worst time
+		(in seconds) from an event's frame being read to the event
+		being picked up, reconnects, and command_stats().'''
+		now = time.monotonic()
+		then, frames_in, bytes_in, frames_out, bytes_out = self._metrics_mark
+		self._metrics_mark = (now, self._frames_in, self._bytes_in, self._frames_out, self._bytes_out)
+		elapsed = max(now - then, 1e-9)
+		delivered, delivery, max_delivery = self._delivery
+		return {
+			"frames_in": self._frames_in,
+			"bytes_in": self._bytes_in,
+			"frames_out": self._frames_out,
+			"bytes_out": self._bytes_out,
+			"frames_in_per_sec": (self._frames_in - frames_in) / elapsed,
+			"bytes_in_per_sec": (self._bytes_in - bytes_in) / elapsed,
+			"frames_out_per_sec": (self._frames_out - frames_out) / elapsed,
+			"bytes_out_per_sec": (self._bytes_out - bytes_out) / elapsed,
+			"events_queued": len(self._q),
+			"frames_queued": len(self._writer),
+			"events_delivered": delivered,
+			"delivery_latency": delivery / delivered if delivered else 0.0,
+			"max_delivery_latency": max_delivery,
+			"reconnects": self._reconnects,
+			"commands": self.command_stats(),
+		}
+	
+	# ---------------
+	 # Helper methods
+	
+	def _handle(self, event, args):
+		handler = self._handlers.get(event)
+		if handler is None:
+			return
+		command_stats = self._command_stats
+		if command_stats is None:
+			handler(self, args)
+		else:
+			start = time.perf_counter()
+			try:
+				handler(self, args)
+			finally:
+				stats = command_stats.setdefault(event, [0, 0.0])
+				stats[0] += 1
+				stats[1] += time.perf_counter() - start
+	
+	def _emit(self, event, **kwargs):
+		kwargs["event"] = event
+		event = chevent(kwargs)
+		event._stamp = self._read_time
+		self._q.put(event)
+	
+	def _delivered(self, latency):
+		delivery = self._delivery
+		delivery[0] += 1
+		delivery[1] += latency
+		if latency > delivery[2]:
+			delivery[2] = latency
+	
+	def _start(self):
+		# Either hand the socket over to the engine or read it ourselves
+		if self._engine:
+			self._engine.add(self)
+		else:
+			_thread.start_new_thread(self._ping, (self._session,))
+			_thread.start_new_thread(self._main, ())
+	
+	def _connect(self):
+		# A new socket to the server, or wherever use_server() says
+		sock = socket.socket()
+		sock.connect(_server_override or (self.server, self.port))
+		return sock
+	
+	def _lost(self):
+		# The connection dropped; get the reconnector onto it
+		if self._engine:
+			self._engine.reconnect(self)
+		elif self._connected:
+			self._inited.clear()
+			_reconnects.schedule(self)
+	
+	def _ping(self, session):
+		time.sleep(60)
+		while self._connected and session == self._session:
+			self._send("")
+			time.sleep(60)
+	
+	def _main(self):
+		while self._connected:
+			event, args = self._recv()
+			try:
+				self._handle(event, args)
+			except Exception as details:
+				_log.error(_get_tb())
+	
+	def _feed(self, data):
+		# Decode a chunk of raw bytes, returning every complete [event, args] in it
+		self._decoder.feed(data)
+		self._bytes_in += len(data)
+		self._read_time = time.monotonic()
+		return [self._parse(x) for x in self._decoder.frames()]
+	
+	def _parse(self, data):
+		if _DEBUG: _log.debug("%s << %r", self._tag, data)
+		self._frames_in += 1
+		event, sep, args = data.partition(":")
+		if event in self._raw_commands and self._handlers.get(event) is self._commands[event]:
+			# Built in handlers that parse as they go get the arguments in one piece
+			return [event, args]
+		return [event, args.split(":") if sep else []]
+	
+	def _recv(self, reconnect=True):
+		if not self._connected:
+			raise NotConnected
+		while not self._frames:
+			sock = self._sock
+			try:
+				read = self._decoder.recv_into(sock)
+			except socket.error:
+				read = 0
+			if not read:
+				# The socket's dead (an empty read means it was closed)
+				if not reconnect:
+					raise NotConnected
+				if not self._connected:
+					return [None, None]
+				if sock is self._sock:
+					self._lost()
+				# Wait for the reconnector to get a new socket going
+				self._inited.wait()
+				if not self._connected:
+					return [None, None]
+				continue
+			self._bytes_in += read
+			self._read_time = time.monotonic()
+			self._frames.extend(self._decoder.frames())
+		return self._parse(self._frames.popleft())
+	
+	def _send(self, *args, terminator="\r\n\x00"):
+		self._push(args, terminator=terminator)
+		self._kick()
+	
+	def _push(self, args, done=None, terminator="\r\n\x00"):
+		# Queue a frame without writing anything yet
+		self._queue(self._frame(args, terminator), done)
+	
+	def _queue(self, data, done=None):
+		# Queue a frame that's already bytes
+		if not self._connected:
+			raise NotConnected
+		self._frames_out += 1
+		self._bytes_out += len(data)
+		self._writer.push(data, done)
+		if _DEBUG: _log.debug("%s >> %r", self._tag, data)
+	
+	def _kick(self):
+		# Get whatever's queued written out
+		if self._engine:
+			self._engine.flush(self)
+		else:
+			self._flush()
+	
+	def _send_now(self, *args, terminator="\r\n\x00"):
+		# For logging in: straight onto the new socket, ahead of anything queued
+		args = self._frame(args, terminator)
+		self._frames_out += 1
+		self._bytes_out += len(args)
+		self._sock.sendall(args)
+		if _DEBUG: _log.debug("%s >> %r", self._tag, args)
+	
+	def _frame(self, args, terminator):
+		args = ":".join([_to_str(x) for x in args])
+		args += terminator
+		return args.encode()
+	
+	def _flush(self):
+		# Write out everything queued, unless another thread's already at it
+		while len(self._writer) and self._flushing.acquire(False):
+			try:
+				data, wait = self._writer.take()
+				if data:
+					try:
+						self._sock.sendall(data)
+					except socket.error:
+						# Send it once we've reconnected
+						self._writer.requeue(data)
+						self._lost()
+						return
+					self._writer.written()
+			finally:
+				self._flushing.release()
+			if wait:
+				if not self._flush_timer:
+					self._flush_timer = threading.Timer(wait, self._timed_flush)
+					self._flush_timer.daemon = True
+					self._flush_timer.start()
+				return
+	
+	def _timed_flush(self):
+		self._flush_timer = None
+		self._flush()
 
 # ---------
 # PMS CLASS
 # ---------
 
-class pms:
-	def __init__(self, username, password):
+class bulkreport:
+	def __init__(self):
+		'''Follows a bulk pms operation, one recipient at a time. queued
+		holds the usernames whose frames haven't been written out yet,
+		sent {username: time written} the ones that have, and failed
+		{username: reason} the ones that couldn't be sent at all.'''
+		self.queued = {}
+		self.sent = {}
+		self.failed = {}
+		self._cond = threading.Condition()
+	
+	def __len__(self):
+		return len(self.queued) + len(self.sent) + len(self.failed)
+	
+	def __contains__(self, username):
+		return username in self.queued or username in self.sent or username in self.failed
+	
+	def status(self, username):
+		'''Returns "queued", "sent" or "failed" for a recipient, or None.'''
+		for status, group in (("sent", self.sent), ("queued", self.queued), ("failed", self.failed)):
+			if username in group:
+				return status
+		return None
+	
+	def done(self):
+		'''Whether or not every recipient has been dealt with.'''
+		return not self.queued
+	
+	def wait(self, timeout=None):
+		'''Wait until every frame has been written, returning done().
+		Frames lost to a disconnect never are, so give a timeout.'''
+		with self._cond:
+			return self._cond.wait_for(self.done, timeout)
+	
+	def _queue(self, username):
+		self.queued[username] = None
+	
+	def _sent(self, username):
+		with self._cond:
+			self.queued.pop(username, None)
+			self.sent[username] = time.time()
+			if not self.queued:
+				self._cond.notify_all()
+	
+	def _fail(self, username, reason):
+		self.failed[username] = reason
+
+class pms(_connection):
+	def __init__(self, username, password, engine=None, events=None):
+		_connection.__init__(self, engine, events)
+		self._tag = "PMS"
+		self.server = "s2.chatango.com"
+		self.port = 443
 		self._username = username
 		self._password = password
 		self._connected = False
 		self._reconnected = False
 		self._logintime = time.time()
+		self._presence = {}
+		self._msgs = msgbuilder("msg", wrap=_pm_body)
 	
 	# ------------------
 	 # Interface methods
@@ -79,19 +1872,21 @@ class pms:
 			self._connected = True
 
 		# Connect to chatango
-		self._sock = socket.socket()
-		self._sock.connect(("s2.chatango.com", 443))
+		sock = self._connect()
 		
 		# Login
-		self._send("tlogin", self._auth, 2, chuser._get_uid())
+		self._uid = chuser._get_uid()
+		with self._flushing:
+			self._sock = sock
+			self._send_now("tlogin", self._auth, 2, self._uid)
 		
 		# Set some personal shiz up
-		self._q = queue.Queue()
-		self._buffer = b''
+		self._decoder.clear()
+		self._frames.clear()
+		self._session = random.randrange(10000,100000)
 		
 		# Start shit
-		_thread.start_new_thread(self._ping, ())
-		_thread.start_new_thread(self._main, ())
+		self._start()
 		
 		# Yay, nothing bad happened
 		return True
@@ -99,16 +1894,46 @@ class pms:
 	def disconnect(self):
 		'''Disconnect from PMs.'''
 		self._connected = False
-		self._sock.close()
+		self._inited.set()
+		if self._engine:
+			self._engine.remove(self)
+		else:
+			_close(self._sock)
 
 	def send(self, username, msg):
 		'''Send msg to username.'''
 		if isinstance(username, chuser):
 			username = username.username
-		msg = _to_str(msg).split("\n")
-		msg = "<P>" + "</P><P>".join(msg) + "</P>"
-		msg = re.sub("\t", " \x01 \x01 \x01 \x01", msg)
-		self._send("msg", username, msg)
+		for frame in self._msgs.build(_to_str(msg), username):
+			self._queue(frame)
+		self._kick()
+	
+	def send_many(self, recipients, msg):
+		'''Send msg to every username (or chuser) in recipients. The
+		message is only formatted once, and the frames are queued all
+		together, going out as fast as the send limits allow (see
+		limit_sends()). Returns a bulkreport for following how each
+		recipient's message went.
+		
+		Ex: pms.send_many(friends, "announcement").wait(60)'''
+		pieces = self._msgs._pieces(_to_str(msg))
+		return self._bulk("msg", recipients, False, build=lambda x: self._msgs._frames(pieces, (x,), True))
+	
+	def add_friend_many(self, usernames):
+		'''add_friend() for every username, see send_many().'''
+		return self._bulk("connect", usernames, True)
+	
+	def remove_friend_many(self, usernames):
+		'''remove_friend() for every username, see send_many().'''
+		return self._bulk("delete", usernames, True)
+	
+	def block_many(self, usernames):
+		'''block() for every username, see send_many().'''
+		return self._bulk("block", usernames, True)
+	
+	def unblock_many(self, usernames):
+		'''unblock() for every username, see send_many().'''
+		return self._bulk("unblock", usernames, True)
 	
 	def add_friend(self, username):
 		'''Add someone to your friends list.'''
@@ -126,7 +1951,19 @@ class pms:
 		'''Unblock a blocked user.'''
 		self._send("unblock", username.lower())
 	
-	def get_event(self):
+	def get_presence(self):
+		'''Returns {username: (online, since)} for everyone on the
+		friends list, kept up to date as they come and go. online is
+		True or False, since the time chatango gave with it.'''
+		return dict(self._presence)
+	
+	def is_online(self, username):
+		'''Whether or not a friend is online, None if they aren't on
+		the friends list.'''
+		presence = self._presence.get(username.lower())
+		return presence[0] if presence else None
+	
+	def get_event(self, timeout=None):
 		'''Wait for the next event from pms. Events are
 		dictionaries with an "event" key holding 1 of 3 values:
 		"message", "login" or "logout".
@@ -136,160 +1973,193 @@ class pms:
 		{
 			"event": "message",
 			"message": <class 'ch.chmessage'>,
+			"username": username,
 			"pms": <class 'ch.pms'>,
-			"reply": <function <lambda>>
+			"reply": <bound method chevent.reply>
 		}
 		{
 			"event": "login",
 			"username": username,
 			"pms": <class 'ch.pms'>,
-			"reply": <function <lambda>>
+			"reply": <bound method chevent.reply>
 		}
 		{
 			"event": "logout",
 			"username": username,
 			"pms": <class 'ch.pms'>,
-			"reply": <function <lambda>>
+			"reply": <bound method chevent.reply>
 		}'''
 		if not self._connected:
 			raise NotConnected
-		return self._q.get(timeout=1000000)
+		return self._q.get(timeout)
 	
 	# ---------------
 	 # Helper methods
 	
-	def _ping(self):
-		time.sleep(60)
-		while self._connected:
-			self._send("")
-			time.sleep(60)
-	
-	def _main(self):
-		while self._connected:
-			event, args = self._recv()
-			try:
-				self._handle(event, args)
-			except Exception as details:
-				print(_get_tb())
-	
-	def _recv(self):
-		if not self._connected:
-			raise NotConnected
-		while self._buffer.startswith(b'\x00'):
-			self._buffer = self._buffer[1:]
-		while not b'\x00' in self._buffer:
-			successful = False
-			while not successful:
-				dc_count = 0
-				next = self._sock.recv(8192)
-				if next == b'':
-					dc_count += 1
-					if dc_count > 5:
-						self._reconnect()
-						continue
-				self._buffer += next
-				successful = True
-		buffer = self._buffer.split(b'\x00')
-		data = b'\r\n'
-		while data == b'\r\n':
-			data = buffer.pop(0)
-		data = data.strip(b'\r\n').decode()
-		self._buffer = b'\x00'.join(buffer)
-		event = data.split(":")[0]
-		args = data.split(":")[1:]
-		if _DEBUG: print("PMS <<", data.encode())
-		return [event, args]
-	
-	def _send(self, *args, terminator="\r\n\x00"):
-		if not self._connected:
-			raise NotConnected
-		args = ":".join([_to_str(x) for x in args])
-		args += terminator
-		args = args.encode()
-		sent = False
-		while not sent:
-			try:
-				self._sock.send(args)
-			except:
-				self._reconnect()
-			else:
-				sent = True
-		if _DEBUG: print("PMS >>", args)
-	
 	def _reconnect(self):
 		# Get the auth token
-		self._auth = _get_auth(self._username, self._password)
+		self._auth = _get_auth(self._username, self._password, refresh=True)
 		
 		# If the password has changed, gracefully exit, mimicking a Kicked-Off
 		if not self._auth:
-			self.diconnect()
+			self.disconnect()
 			raise KickedOff
 		
 		# Connect to chatango
-		self._sock = socket.socket()
-		self._sock.connect(("s2.chatango.com", 443))
+		if self._engine:
+			self._engine.remove(self)
+			self._outbuf = bytearray()
+			self._writer.unwritten()
+		else:
+			_close(self._sock)
+		sock = self._connect()
 		
-		# Login
-		self._send("tlogin", self._auth, 2, self._user.uid)
+		# Login, before a flush from another thread can get anything
+		# queued onto the new socket
+		with self._flushing:
+			self._sock = sock
+			self._send_now("tlogin", self._auth, 2, self._uid)
 		
 		# Handle incoming messages differently, now
 		self._reconnected = True
-		self._buffer = b''
+		self._decoder.clear()
+		self._frames.clear()
+		if self._engine:
+			self._engine.add(self)
+		else:
+			self._inited.set()
+			self._flush()
+	
+	def _bulk(self, command, usernames, lower, *args, build=None):
+		# Queue the frames for each recipient, flushing once at the end
+		if not self._connected:
+			raise NotConnected
+		report = bulkreport()
+		for username in usernames:
+			if isinstance(username, chuser):
+				username = username.username
+			username = _to_str(username)
+			if lower:
+				username = username.lower()
+			if username in report:
+				continue
+			if not username or ":" in username:
+				report._fail(username, "invalid username")
+				continue
+			report._queue(username)
+			if build is None:
+				frames = [self._frame((command, username) + args, "\r\n\x00")]
+			else:
+				frames = build(username)
+			for frame in frames[:-1]:
+				self._queue(frame)
+			# Only sent once the last of them is
+			self._queue(frames[-1], functools.partial(report._sent, username))
+		self._kick()
+		return report
 	
 	# ------------------
-	 # PMS Event Handler
+	 # PMS Event Handlers
 	
-	def _handle(self, event, args):
-		if event == "time":
-			self._logintime = float(args[0])
-		elif event == "seller_name":
-			username, self._uid = args
-			self._uid = int(self._uid)
-		elif event == "kickingoff":
-			raise KickedOff
-		elif event == "wloffline":
-			username, logintime = args
-			logintime = float(logintime)
-			self._q.put({"event": "logout", "username": username, "pms": self, "reply": lambda x: self.send(username, x)})
-		elif event == "wlonline":
-			username, logintime = args
-			logintime = float(logintime)
-			self._q.put({"event": "login", "username": username, "pms": self, "reply": lambda x: self.send(username, x)})
-		elif event == "msg" or (event == "msgoff" and self._reconnected == True):
-			username, anon_uid, unknown, posttime, pro = args[:5]
-			if username.startswith("*"):
-				user_type = chuser.ANON
-				username = "anon" + anon_uid[-4:]
-			else:
-				user_type = chuser.REGD
-			posttime = float(posttime)
-			raw = ":".join(args[5:])
-			content = re.sub("</P><P>", "\n", raw)
-			content = re.sub("<[^>]+>", "", content)
-			msg = chmessage(posttime=posttime, formatted=raw, content=content, user=chuser(username=username, type=user_type))
-			self._q.put({"event": "message", "message": msg, "pms": self, "reply": lambda x: self.send(username, x)})
-
-class chatroom:
-	def __init__(self, name):
+	def _cmd_OK(self, args):
+		# Logged in; ask for the friends list so presence starts out filled in
+		self._send("wl")
+	
+	def _cmd_wl(self, args):
+		# The friends list: username, last seen, on/off/app, idle time, and again
+		for x in range(0, len(args) - 3, 4):
+			username, logintime, status = args[x:x + 3]
+			try:
+				logintime = float(logintime)
+			except ValueError:
+				logintime = None
+			self._presence[username.lower()] = (status != "off", logintime)
+	
+	def _cmd_time(self, args):
+		self._logintime = float(args[0])
+	
+	def _cmd_seller_name(self, args):
+		username, self._uid = args
+		self._uid = int(self._uid)
+	
+	def _cmd_kickingoff(self, args):
+		raise KickedOff
+	
+	def _cmd_wloffline(self, args):
+		username, logintime = args
+		logintime = float(logintime)
+		self._presence[username.lower()] = (False, logintime)
+		self._emit("logout", username=username, pms=self)
+	
+	def _cmd_wlonline(self, args):
+		username, logintime = args
+		logintime = float(logintime)
+		self._presence[username.lower()] = (True, logintime)
+		self._emit("login", username=username, pms=self)
+	
+	def _cmd_msg(self, args):
+		username, anon_uid, unknown, posttime, pro = args[:5]
+		if username.startswith("*"):
+			user_type = chuser.ANON
+			username = "anon" + anon_uid[-4:]
+		else:
+			user_type = chuser.REGD
+		posttime = float(posttime)
+		raw = ":".join(args[5:])
+		msg = chmessage(posttime=posttime, formatted=raw, user=chuser(username=username, type=user_type))
+		self._emit("message", message=msg, username=username, pms=self)
+	
+	def _cmd_msgoff(self, args):
+		# Offline messages are only news if we've been away
+		if self._reconnected:
+			self._cmd_msg(args)
+	
+	_commands = {
+		"OK": _cmd_OK,
+		"wl": _cmd_wl,
+		"time": _cmd_time,
+		"seller_name": _cmd_seller_name,
+		"kickingoff": _cmd_kickingoff,
+		"wloffline": _cmd_wloffline,
+		"wlonline": _cmd_wlonline,
+		"msg": _cmd_msg,
+		"msgoff": _cmd_msgoff,
+	}
+
+class chatroom(_connection):
+	def __init__(self, name, engine=None, events=None):
+		_connection.__init__(self, engine, events)
 		self.name = name.lower()
+		self._tag = self.name
 		self._mods = ()
 		self._user = chuser()
 		self._premium = False
-		self._buffer = b''
-		self._online = []
-		self._history = []
-		self._noid_messages = {}
-		self._bw_regx = []
+		self._online = chparticipants()
+		self._loading = None
+		self._gone = set()
+		self._history = chhistory()
+		self._users = weakref.WeakValueDictionary()
+		self._archive = None
+		self._pending = collections.OrderedDict()
+		self._pending_counts = [0, 0]
+		self._early = False
+		self.badwords = []
+		self._bw_words = []
+		self._bw_regx = None
 		self._connected = False
 		self._reconnected = False
-		self._ignore_messages = {}
+		self._filter = msgfilter()
 		self.server = "s%i.chatango.com" % _get_server_num(self.name)
+		self.port = 443
 		# Register some default settings
 		self.obey_badwords()
 		self.keep_history(100)
+		self.limit_pending()
 		self.silent(False)
 		self._font = {}
-	font = property(lambda x: '<n%s/><f x%s%s="%s">' % (x._font.get("name") or "", x._font.get("size") or "", x._font.get("color") or "", _font_family.get(x._font.get("family")) or ""))
+		self._says = msgbuilder("bmsg:t12r")
+		self._says.set_prefix(self._font_tags())
+	font = property(lambda x: x._says.prefix)
 	
 	# -------------------
 	 # Connection methods
@@ -320,29 +2190,37 @@ class chatroom:
 			self._send("blogin", self._user.displayname)
 		elif not self._connected:
 			# Login for the first time
-			self._sock = socket.socket()
-			self._sock.connect((self.server, 443))
+			sock = self._connect()
 			self._connected = True
 			
 			# Send the login info
-			if self._user.username and self._user.password:
-				self._send("bauth", self.name, self._user.uid, self._user.displayname, self._user.password, terminator="\x00")
-			else:
-				self._send("bauth", self.name, terminator="\x00")
+			with self._flushing:
+				self._sock = sock
+				if self._user.username and self._user.password:
+					self._send_now("bauth", self.name, self._user.uid, self._user.displayname, self._user.password, terminator="\x00")
+				else:
+					self._send_now("bauth", self.name, terminator="\x00")
 			
 			# Set some personal shiz up
 			self._session = random.randrange(10000,100000)
-			self._q = queue.Queue()
 			
-			# Wait to get inited
-			event = None
-			while event != "inited":
-				event, args = self._recv()
-				self._handle(event, args)
-			
-			# Start shit
-			_thread.start_new_thread(self._ping, (self._session,))
-			_thread.start_new_thread(self._main, ())
+			if self._engine:
+				# The engine does the reading, so just wait for it to get us inited
+				self._inited.clear()
+				self._start()
+				if not self._engine.in_loop():
+					self._inited.wait()
+					if not self._connected:
+						raise NotConnected
+			else:
+				# Wait to get inited
+				event = None
+				while event != "inited":
+					event, args = self._recv(False)
+					self._handle(event, args)
+				
+				# Start shit
+				self._start()
 			
 		# Yay, nothing bad happened
 		return True
@@ -354,9 +2232,13 @@ class chatroom:
 	def disconnect(self):
 		'''Disconnect from the chatroom.'''
 		self._connected = False
-		self._sock.close()
+		self._inited.set()
+		if self._engine:
+			self._engine.remove(self)
+		else:
+			_close(self._sock)
 	
-	def get_event(self):
+	def get_event(self, timeout=None):
 		'''Wait for the next event from the chatroom. Events
 		are dictionaries with an "event" key holding 1 of 4 values:
 		"message", "login", "logout" or "nickchange".
@@ -367,32 +2249,32 @@ class chatroom:
 			"event": "message",
 			"message": <class 'ch.chmessage'>,
 			"room": <class 'ch.chatroom'>,
-			"reply": <function <lambda>>
+			"reply": <bound method chevent.reply>
 		}
 		{
 			"event": "login",
 			"username": username,
 			"user": <class 'ch.chuser'>,
 			"room": <class 'ch.chatroom'>,
-			"reply": <function <lambda>>
+			"reply": <bound method chevent.reply>
 		}
 		{
 			"event": "logout",
 			"username": username,
 			"user": <class 'ch.chuser'>,
 			"room": <class 'ch.chatroom'>,
-			"reply": <function <lambda>>
+			"reply": <bound method chevent.reply>
 		}
 		{
 			"event": "nickchange",
 			"old": <class 'ch.chuser'>,
 			"new": <class 'ch.chuser'>,
 			"room": <class 'ch.chatroom'>,
-			"reply": <function <lambda>>
+			"reply": <bound method chevent.reply>
 		}'''
 		if not self._connected:
 			raise NotConnected
-		return self._q.get(timeout=1000000)
+		return self._q.get(timeout)
 	
 	# ----------------------------
 	 # Interface with the chatroom
@@ -401,15 +2283,16 @@ class chatroom:
 		'''Say something in the chatroom. If the raw option is True,
 		html tags are embedded, else they are escaped.'''
 		if not self._silenced:
+			msg = _to_str(msg)
 			if not raw:
 				msg = msg.replace("<", "&lt;")
-			if self._obey_badwords:
-				for word in self._bw_regx:
-					msg = re.sub(word, "*", msg, re.IGNORECASE)
-			if self._user.type == chuser.REGD:
-				self._send("bmsg:t12r", self.font + _to_str(msg))
-			else:
-				self._send("bmsg:t12r", _to_str(msg))
+			bw_regx = self._bw_regx
+			if self._obey_badwords and bw_regx:
+				msg = bw_regx.sub("*", msg)
+			# Only registered users get to pick a font
+			for frame in self._says.build(msg, prefix=self._user.type == chuser.REGD):
+				self._queue(frame)
+			self._kick()
 	
 	def find_user(self, key, online=True, history=True):
 		'''Finds a user based on the lambda function key. Optionally
@@ -427,11 +2310,18 @@ class chatroom:
 	
 	def is_online(self, username):
 		'''Search the online list for a registered user.'''
-		username.lower()
-		if self.find_user(lambda x: x.username == username and x.type == chuser.REGD):
-			return True
-		else:
-			return False
+		return self._online.is_online(username)
+	
+	def get_online(self):
+		'''Returns a list of the chuser objects of everyone online (or
+		everyone registered, see track_participants()).'''
+		return self._online.snapshot()
+	
+	def count_online(self, type=None):
+		'''How many people are online, of one type (chuser.ANON, TEMP
+		or REGD) or all together. Counts are kept whatever the mode of
+		track_participants().'''
+		return self._online.count(type)
 	
 	def is_mod(self, username=None):
 		'''See if a person is a mod in the chatroom. If no argument is
@@ -445,15 +2335,28 @@ class chatroom:
 	def get_history(self, user):
 		'''Takes a chuser object and returns that person's history
 		in the chatroom.'''
-		matches = []
-		for msg in self._history:
-			if msg.user.type == chuser.REGD and msg.user.username == user.username:
-				matches.append(msg)
-			elif msg.user.type == chuser.ANON and user.uid and msg.user.uid == user.uid:
-				matches.append(msg)
-			elif msg.user.type == chuser.TEMP and user.uid and [msg.user.uid, msg.user.username, msg.user.type] == [user.uid, user.username, user.type]:
-				matches.append(msg)
-		return matches
+		matches = [msg for msg in self._history.by_username(user.username) if msg.user.type == chuser.REGD]
+		if user.uid:
+			for msg in self._history.by_uid(user.uid):
+				if msg.user.type == chuser.ANON:
+					matches.append(msg)
+				elif msg.user.type == chuser.TEMP and [msg.user.username, msg.user.type] == [user.username, user.type]:
+					matches.append(msg)
+		return sorted(matches, key=_posttime)
+	
+	def metrics(self):
+		'''See _connection.metrics(), plus how many new messages are
+		waiting for an mid, how many got one and how many were given up
+		on (too old, too many waiting or cut off by a reconnect).'''
+		metrics = _connection.metrics(self)
+		metrics["pending_messages"] = len(self._pending)
+		metrics["pending_matched"], metrics["pending_expired"] = self._pending_counts
+		return metrics
+	
+	def get_message(self, mid):
+		'''Returns the chmessage with the given mid if it's still in
+		the room's history, else None.'''
+		return self._history.get(mid)
 	
 	# ------------------
 	 # Moderator methods
@@ -478,10 +2381,15 @@ class chatroom:
 	
 	def deleteall(self, username):
 		'''Delete all posts made by someone with the given username.'''
-		username = username.lower()
-		matches = self.find_user(lambda x: x.username == username)
-		for match in matches:
-			self._send("delallmsg", match.umid)
+		umids = []
+		for msg in self._history.by_username(username):
+			umid = msg.umid or msg.user.umid
+			if umid and umid not in umids:
+				umids.append(umid)
+		if umids:
+			for umid in umids:
+				self._push(("delallmsg", umid))
+			self._kick()
 	
 	# -------------------------
 	 # Manipulate room settings
@@ -491,7 +2399,35 @@ class chatroom:
 		size = int(size)
 		if size < 10:
 			size = 10
-		self._history_limit = size
+		self._history.set_limit(size)
+	
+	def limit_pending(self, size=1000, ttl=30):
+		'''Control how many new messages can be waiting for chatango to
+		give them an mid, and for how many seconds, before they're given
+		up on. Messages deleted or cut off by a reconnect never get one.'''
+		self._pending_size = max(1, int(size))
+		self._pending_ttl = ttl
+		while len(self._pending) > self._pending_size:
+			self._pending.popitem(False)
+			self._pending_counts[1] += 1
+	
+	def deliver_early(self, value=True):
+		'''Control whether or not new messages are emitted as soon as
+		they arrive, rather than once chatango gives them their mid. The
+		message event then comes with msg.mid as None, followed by a
+		mid_assigned event once it's known (if it ever is).'''
+		self._early = bool(value)
+	
+	def set_archive(self, archive):
+		'''Keep every message on disk in the given archive object, on top
+		of the history kept in memory. None stops archiving.'''
+		self._archive = archive
+	
+	def track_participants(self, mode=chparticipants.REGISTERED):
+		'''Control which of the people online get a chuser kept for them:
+		chparticipants.ALL, REGISTERED (the default) or COUNTS for none.
+		In a room with tens of thousands of people, COUNTS saves a lot.'''
+		self._online.set_mode(mode)
 	
 	def obey_badwords(self, value=True):
 		'''Control whether or not you can avoid word filters.'''
@@ -504,18 +2440,28 @@ class chatroom:
 	def ignore(self, keyname, key):
 		'''Add a function to be applied to new messages.
 		If the function returns True, the message is ignored.
+		Rules added to the room's msgfilter are much cheaper.
 		
 		Ex: ignore("anons", lambda x: x.user.type == chuser.ANON)'''
 		if key != None and isinstance(key, type(lambda x: None)):
-			self._ignore_messages[keyname] = key
+			self._filter.add(keyname, func=key)
 	
 	def unignore(self, keyname):
 		'''Provide a keyname associated with an ignore function
-		to stop applying that function to incoming messages.'''
-		try:
-			self._ignore_messages.pop(keyname)
-		except:
-			pass
+		(or filter rule) to stop applying it to incoming messages.'''
+		self._filter.remove(keyname)
+	
+	def set_filter(self, filter):
+		'''Decide which new messages are ignored with the given msgfilter,
+		which can be shared with other rooms. Returns the old one.'''
+		old, self._filter = self._filter, filter
+		return old
+	
+	def get_filter(self):
+		'''Returns the room's msgfilter, for adding rules to.
+		
+		Ex: room.get_filter().add("flood", rate=(5, 10))'''
+		return self._filter
 	
 	def set_font(self, size=None, family=None, color=None, name=None):
 		'''Independently or simultaneously set the size, family,
@@ -527,9 +2473,10 @@ class chatroom:
 			elif not self._premium and size > 14:
 				size = 14
 		if size != None: self._font["size"] = size
-		if name != None: self._font["name"] = color
+		if name != None: self._font["name"] = name
 		if color != None: self._font["color"] = color
 		if family != None: self._font["family"] = family
+		self._says.set_prefix(self._font_tags())
 	
 	def use_bg(self, value=True):
 		'''Turn your background on or off.'''
@@ -575,279 +2522,1210 @@ class chatroom:
 	# ---------------
 	# Helper methods
 
-	def _ping(self, session):
-		time.sleep(60)
-		while self._connected and session == self._session:	
-			self._send("")
-			time.sleep(60)
-	
-	def _main(self):
-		while self._connected:
-			event, args = self._recv()
-			try:
+	def _reconnect(self):
+		# Start a new connection
+		if self._engine:
+			self._engine.remove(self)
+			self._outbuf = bytearray()
+			self._writer.unwritten()
+		else:
+			_close(self._sock)
+		sock = self._connect()
+		self._decoder.clear()
+		self._frames.clear()
+		
+		# Send the login info, before a flush from another thread can get
+		# anything queued onto the new socket
+		with self._flushing:
+			self._sock = sock
+			if self._user.username and self._user.password:
+				self._send_now("bauth", self.name, self._user.uid, self._user.username, self._user.password)
+			else:
+				self._send_now("bauth", self.name, terminator="\x00")
+		
+		# Handle messages differently evermore
+		self._reconnected = True
+		# Nothing from the old connection is getting an mid now
+		self._pending_counts[1] += len(self._pending)
+		self._pending.clear()
+		
+		if self._engine:
+			# The engine picks it up from here
+			self._engine.add(self)
+		else:
+			# Wait to get inited, then send whatever piled up meanwhile
+			event = None
+			while event != "inited":
+				event, args = self._recv(False)
 				self._handle(event, args)
-			except Exception as details:
-				print(_get_tb())
+			self._flush()
 	
-	def _recv(self):
-		if not self._connected:
-			raise NotConnected
-		while self._buffer.startswith(b'\x00'):
-			self._buffer = self._buffer[1:]
-		while not b'\x00' in self._buffer:
-			successful = False
-			while not successful:
-				dc_count = 0
-				try:
-					next = self._sock.recv(8192)
-				except socket.error:
-					if self._connected:
-						self._reconnect()
-					else:
-						return [None, None]
-				if next == b'':
-					dc_count += 1
-					if dc_count > 5:
-						self._reconnect()
-						continue
-				self._buffer += next
-				successful = True
-		buffer = self._buffer.split(b'\x00')
-		data = b'\r\n'
-		while data == b'\r\n':
-			data = buffer.pop(0)
-		data = data.strip(b'\r\n').decode()
-		self._buffer = b'\x00'.join(buffer)
-		event = data.split(":")[0]
-		args = data.split(":")[1:]
-		if _DEBUG: print(self.name, "<<", data.encode())
-		return [event, args]
+	def _font_tags(self):
+		font = self._font
+		return '<n%s/><f x%s%s="%s">' % (font.get("name") or "", font.get("size") or "", font.get("color") or "", _font_family.get(font.get("family")) or "")
 	
-	def _send(self, *args, terminator="\r\n\x00"):
-		if not self._connected:
-			raise NotConnected
-		args = ":".join([_to_str(x) for x in args])
-		args += terminator
-		args = args.encode()
-		sent = False
-		while not sent:
-			try:
-				self._sock.send(args)
-			except:
-				self._reconnect()
-			else:
-				sent = True
-		if _DEBUG: print(self.name, ">>", args)
+	def _add_history(self, msg, checked=False):
+		if self._reconnected and msg.type == chmessage.HISTORY:
+			# Only history we missed while reconnecting is news
+			if msg.mid in self._history:
+				return
+			msg.type = chmessage.NEW
+		if not self._history.add(msg):
+			return
+		if _directory is not None:
+			_directory.see(msg.user, self.name, msg.posttime, msg.umid)
+		if self._archive:
+			self._archive.write(self.name, msg)
+		if msg.type == chmessage.NEW and not checked:
+			self._deliver(msg)
+	
+	def _deliver(self, msg):
+		# Emit a new message unless it's ignored, returning whether it was
+		if _flood is not None:
+			for kind, posts in _flood.check(msg, self.name):
+				self._flooded(kind, posts)
+		if self._filter and self._filter.match(msg) is not None:
+			return False
+		self._emit("message", message=msg, room=self)
+		return True
+	
+	def _expire_pending(self, now):
+		# The oldest are at the front; drop them while they're too old
+		pending = self._pending
+		cutoff = now - self._pending_ttl
+		while pending:
+			index = next(iter(pending))
+			if pending[index][1] >= cutoff:
+				break
+			del pending[index]
+			self._pending_counts[1] += 1
+	
+	def _flooded(self, kind, posts):
+		self._emit("flood", room=self, **_flood_details(kind, posts))
+	
+	# -----------------------
+	 # Chatroom Event Handlers
+	
+	def _cmd_ok(self, args):
+		self._connected = True
+		self.admin = args[0]
+		self._user.uid = int(args[1])
+		self._user.logintime = float(args[4])
+		self._user.ip = args[5]
+		self._mods = args[6].split(";")
 		
-	def _reconnect(self):
-		# Start a new connection
-		self._sock = socket.socket()
-		self._sock.connect((self.server, 443))
+		if args[2] == "M":
+			self._user.type = chuser.REGD
+		elif args[2] == "C":
+			self._user.type = chuser.TEMP
+		elif args[2] == "N":
+			self._user.type = chuser.ANON
+	
+	def _cmd_denied(self, args):
+		self.disconnect()
+	
+	def _cmd_inited(self, args):
+		self._inited.set()
+		# Set up full name alerts and shit
+		self._push(("g_participants:start",))
+		# Get updated with the list of badwords
+		self._push(("getbannedwords",))
+		self._push(("checkbannedwords",))
+		# Check for premium status
+		self._push(("getpremium", 1))
+		# Log in with a temp name if need be
+		if self._user.type == chuser.TEMP:
+			self._push(("blogin", self._user.displayname))
+		self._kick()
+	
+	def _cmd_pwdok(self, args):
+		self._user.type = chuser.REGD
+		self._send("getpremium", 1)
+	
+	def _cmd_aliasok(self, args):
+		self._user.type = chuser.TEMP
+		self._send("getpremium", 1)
+	
+	def _cmd_logoutok(self, args):
+		self._user.type = chuser.ANON
+		self._send("getpremium", 1)
+	
+	def _cmd_show_fw(self, args):
+		self._lost()
+	
+	def _cmd_ubw(self, args):
+		self._send("getbannedwords")
+	
+	def _cmd_bw(self, args):
+		bw = args[1]
+		if not bw:
+			self.badwords = []
+		else:
+			bw = urllib.parse.unquote(bw)
+			bw = bw.strip(",").split(",")
+			self.badwords = bw
+		# Only recompile when the list actually changed
+		if self.badwords != self._bw_words:
+			self._bw_words = self.badwords
+			self._bw_regx = _word_pattern(self.badwords)
+	
+	def _cmd_premium(self, args):
+		if args[1] != '0':
+			self._premium = True
+		else:
+			self._premium = False
+	
+	def _cmd_n(self, args):
+		self.size = int(args[0], 16)
+	
+	def _cmd_mods(self, args):
+		self._mods = args
+	
+	def _parse_message(self, args):
+		posttime, reg_name, tmp_name, uid, umid, index, ip, x = args[:8]
+		msg = ":".join(args[8:])
+		ts = _head_regx.match(msg).group(1) or ""
+		ts = ts if ts.isdigit() else ""
 		
-		# Send the login info
-		if self._user.username and self._user.password:
-			self._send("bauth", self.name, self._user.uid, self._user.username, self._user.password)
+		if reg_name == tmp_name == "":
+			user_type = chuser.ANON
+			username = ""
+		elif reg_name == "":
+			user_type = chuser.TEMP
+			username = tmp_name
 		else:
-			self._send("bauth", self.name, terminator="\x00")
+			user_type = chuser.REGD
+			username = reg_name
 		
-		# Handle messages differently evermore
-		self._reconnected = True
+		u = self._get_user(username, uid, umid, ip, user_type, ts)
+		return chmessage(posttime=float(posttime), formatted=msg, umid=umid, index=index, user=u)
+	
+	def _get_user(self, username, uid, umid, ip, user_type, ts):
+		# Hand out one chuser per person, for as long as any message still
+		# holds on to it. Everything about them is in the key, so a new uid,
+		# umid or ip gets its own chuser rather than rewriting the one older
+		# messages hold.
+		if user_type == chuser.ANON:
+			key = (user_type, uid, umid, ip, ts)
+		else:
+			key = (user_type, uid, umid, ip, username.lower())
+		u = self._users.get(key)
+		if u is None:
+			u = chuser(username=username, uid=uid, umid=umid, ip=ip, type=user_type, ts=ts)
+			self._users[key] = u
+		return u
+	
+	def _cmd_b(self, args):
+		msg = self._parse_message(args)
+		msg.type = chmessage.NEW
+		now = time.monotonic()
+		self._expire_pending(now)
+		# Hold on to it until its mid comes, deciding now if it's early
+		shown = self._deliver(msg) if self._early else None
+		pending = self._pending
+		pending[msg.index] = (msg, now, shown)
+		if len(pending) > self._pending_size:
+			pending.popitem(False)
+			self._pending_counts[1] += 1
+	
+	def _cmd_i(self, args):
+		msg = self._parse_message(args)
+		msg.type = chmessage.HISTORY
+		msg.mid = msg.index
+		del msg.index
+		self._add_history(msg)
+	
+	def _cmd_u(self, args):
+		index, mid = args
+		entry = self._pending.pop(index, None)
+		if entry:
+			msg, when, shown = entry
+			msg.mid = mid
+			self._pending_counts[0] += 1
+			self._add_history(msg, shown is not None)
+			if shown:
+				self._emit("mid_assigned", message=msg, mid=mid, room=self)
+	
+	def _cmd_g_participants(self, args):
+		# This is the whole list, so start over
+		self._online.clear()
+		self._gone.clear()
+		self._loading = _participant_entries(args)
+		self._load_participants()
+	
+	def _load_participants(self):
+		# Work through the list a slice at a time, letting an engine get
+		# to its other sockets in between
+		entries = self._loading
+		if entries is None:
+			return
+		online = self._online
+		count = 0
+		for session, logintime, uid, reg_name, tmp_name in entries:
+			session = int(session)
+			if session not in self._gone:
+				user_type, username = _participant_type(reg_name, tmp_name)
+				if online._keeps(user_type):
+					online.add(chuser(session=session, uid=uid, logintime=logintime, username=username, type=user_type))
+				else:
+					online.add_session(session, user_type, username)
+			count += 1
+			if count == _PARTICIPANTS_SLICE and self._engine:
+				self._engine.later(self._load_participants)
+				return
+		if self._loading is not entries:
+			# A newer list came in and took over
+			return
+		self._loading = None
+		self._gone.clear()
+		self._emit("participants_loaded", count=online.count(), registered=online.count(chuser.REGD), room=self)
+	
+	def _cmd_participant(self, args):
+		p_event, session, uid, reg_name, tmp_name, ip, logintime = args
+		session = int(session)
+		user_type, username = _participant_type(reg_name, tmp_name)
+		u = chuser(session=session, uid=uid, username=username, type=user_type, logintime=logintime, ip=ip)
+		old_type = self._online.type_of(session)
+		old_name = self._online.name_of(session) if p_event == "2" else None
 		
-		# Wait to get inited
-		event = None
-		while event != "inited":
-			event, args = self._recv()
-			self._handle(event, args)
+		if p_event == "0":
+			# The user logged out
+			if self._loading is not None:
+				self._gone.add(session)
+			self._online.remove(session)
+			if old_type == chuser.REGD:
+				self._emit("logout", username=u.username, user=u, room=self)
+		elif p_event == "1":
+			# The user logged in
+			if _directory is not None:
+				_directory.see(u, self.name)
+			self._online.add(u)
+			if u.type == chuser.REGD:
+				self._emit("login", username=u.username, user=u, room=self)
+		elif p_event == "2":
+			if _directory is not None and u.type != chuser.ANON:
+				_directory.see(u, self.name)
+			user_ = self._online.rename(session, u)
+			if user_ is None and old_type is not None:
+				# Not everyone's kept, but there's enough here to say who they were
+				user_ = chuser(session=session, uid=uid, username=old_name or "", type=old_type)
+			if user_:
+				self._emit("nickchange", old=user_, new=u, room=self)
 	
-	def _add_history(self, msg):
-		if self._reconnected and msg.type == chmessage.HISTORY:
-			# Go through the list and make sure that this message doesn't already exist
-			append = True
-			for message in self._history:
-				if msg.mid == message.mid:
-					append = False
-			if append:
-				msg.type = chmessage.NEW
-				self._history.append(msg)
-				self._history = sorted(self._history, key=lambda x: x.posttime)
-			else:
+	_commands = {
+		"b": _cmd_b,
+		"u": _cmd_u,
+		"i": _cmd_i,
+		"participant": _cmd_participant,
+		"n": _cmd_n,
+		"g_participants": _cmd_g_participants,
+		"ok": _cmd_ok,
+		"denied": _cmd_denied,
+		"inited": _cmd_inited,
+		"pwdok": _cmd_pwdok,
+		"aliasok": _cmd_aliasok,
+		"logoutok": _cmd_logoutok,
+		"show_fw": _cmd_show_fw,
+		"show_tb": _cmd_show_fw,
+		"ubw": _cmd_ubw,
+		"bw": _cmd_bw,
+		"premium": _cmd_premium,
+		"mods": _cmd_mods,
+	}
+	_raw_commands = frozenset(["g_participants"])
+
+# ------------------------------------------------
+# Reconnect scheduling, with backoff, for everyone
+# ------------------------------------------------
+
+class reconnector:
+	def __init__(self, base=1, cap=300, jitter=0.5, per_server=4, stable=60):
+		'''Reconnects dropped connections from one background thread.
+		The first try comes after a random delay of up to base seconds,
+		so a blip doesn't have every room reconnecting at once, then
+		each failure doubles the delay up to cap seconds, give or take
+		jitter (a fraction of the delay). At most per_server reconnects
+		run at once for any one server. A connection that stays up for
+		stable seconds starts from scratch the next time it drops.'''
+		self.base = base
+		self.cap = cap
+		self.jitter = jitter
+		self.per_server = per_server
+		self.stable = stable
+		self.reconnects = 0
+		self.failures = 0
+		self._lock = threading.Condition()
+		self._heap = []
+		self._count = 0
+		self._pending = set()
+		self._running = {}
+		self._attempts = weakref.WeakKeyDictionary()
+		self._started = False
+
+	def schedule(self, conn):
+		'''Reconnect conn when its turn comes up. Does nothing if it's
+		already waiting for one.'''
+		with self._lock:
+			if conn in self._pending:
 				return
+			self._pending.add(conn)
+			attempt, last = self._attempts.get(conn, (0, None))
+			if last and time.monotonic() - last > self.stable:
+				attempt = 0
+			self._attempts[conn] = (attempt + 1, last)
+			self._push(conn, self._delay(attempt))
+			if not self._started:
+				self._started = True
+				_thread.start_new_thread(self._run, ())
+			self._lock.notify()
+
+	def stats(self):
+		'''Returns how many reconnects are waiting and running, and how
+		many have succeeded and failed.'''
+		with self._lock:
+			return {
+				"pending": len(self._pending),
+				"running": sum(self._running.values()),
+				"reconnects": self.reconnects,
+				"failures": self.failures,
+			}
+
+	def _delay(self, attempt):
+		if not attempt:
+			return random.uniform(0, self.base)
+		delay = min(self.cap, self.base * 2 ** attempt)
+		return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+	def _push(self, conn, delay):
+		self._count += 1
+		heapq.heappush(self._heap, (time.monotonic() + delay, self._count, conn))
+
+	def _run(self):
+		while True:
+			with self._lock:
+				while not self._heap:
+					self._lock.wait()
+				due, count, conn = self._heap[0]
+				now = time.monotonic()
+				if due > now:
+					self._lock.wait(due - now)
+					continue
+				heapq.heappop(self._heap)
+				if not conn._connected:
+					self._pending.discard(conn)
+					continue
+				server = conn.server
+				if self._running.get(server, 0) >= self.per_server:
+					# Too many on this server already, try again in a bit
+					self._push(conn, random.uniform(0.1, 0.5))
+					continue
+				self._running[server] = self._running.get(server, 0) + 1
+			_thread.start_new_thread(self._reconnect, (conn, server))
+
+	def _reconnect(self, conn, server):
+		try:
+			conn._reconnect()
+		except (KickedOff, InvalidCredentials):
+			ok = None
+			_log.error(_get_tb())
+			conn.disconnect()
+		except Exception as details:
+			ok = False
+			_log.error(_get_tb())
+		else:
+			ok = True
+		with self._lock:
+			self._running[server] -= 1
+			if not self._running[server]:
+				del self._running[server]
+			self._pending.discard(conn)
+			attempt, last = self._attempts.get(conn, (1, None))
+			if ok:
+				self.reconnects += 1
+				conn._reconnects += 1
+				self._attempts[conn] = (attempt, time.monotonic())
+			elif ok is False:
+				self.failures += 1
+				if conn._connected:
+					self._attempts[conn] = (attempt + 1, last)
+					self._pending.add(conn)
+					self._push(conn, self._delay(attempt))
+			self._lock.notify()
+
+# ------------------------------------------------------------
+# Engine for driving lots of connections from one event loop
+# ------------------------------------------------------------
+
+class engine:
+	def __init__(self, ping_interval=60, resolution=1):
+		'''Drives the sockets of any number of chatroom and pms objects
+		from a single asyncio event loop running in one background thread,
+		instead of two threads per connection. Pings are spread over a
+		timer wheel with one slot every resolution seconds, so each tick
+		only touches the connections that are due.
+		
+		Ex: e = engine(); room = chatroom("room", engine=e)'''
+		self._loop = asyncio.new_event_loop()
+		self._resolution = resolution
+		self._wheel = [set() for x in range(max(1, int(ping_interval / resolution)))]
+		self._slot = 0
+		self._conns = {}
+		self._slots = {}
+		self._timers = {}
+		self._thread = None
+		_thread.start_new_thread(self._run, ())
+	
+	# ------------------
+	 # Interface methods
+	
+	def add(self, conn):
+		'''Start reading from a connected chatroom or pms object.'''
+		self.call(self._attach, conn)
+	
+	def remove(self, conn):
+		'''Stop reading from a chatroom or pms object and close its socket.'''
+		self.call(self._detach, conn)
+	
+	def flush(self, conn):
+		'''Write out whatever the connection has queued.'''
+		self.call(self._flush, conn)
+	
+	def reconnect(self, conn):
+		'''Drop a connection and have the reconnector bring it back.'''
+		self.call(self._lost, conn)
+	
+	def call(self, func, *args):
+		'''Run func(*args) on the event loop, right away if we're
+		already on it.'''
+		if self.in_loop():
+			func(*args)
 		else:
-			self._history.append(msg)
-		if msg.type == chmessage.HISTORY:
-			self._history = sorted(self._history, key=lambda x: x.posttime)
-		if msg.type == chmessage.NEW:
-			addq = True
-			for key in self._ignore_messages:
-				func = self._ignore_messages.get(key)
-				if func(msg):
-					addq = False
+			self._loop.call_soon_threadsafe(func, *args)
+	
+	def later(self, func, *args):
+		'''Run func(*args) on the event loop, after whatever's already
+		waiting to run.'''
+		self._loop.call_soon_threadsafe(func, *args)
+	
+	def in_loop(self):
+		'''Whether or not the calling thread is the engine's thread.'''
+		return _thread.get_ident() == self._thread
+	
+	def connections(self):
+		'''Return a list of the connections being driven.'''
+		return list(self._conns)
+	
+	def stop(self):
+		'''Disconnect everything and stop the event loop.'''
+		self.call(self._stop)
+	
+	# ---------------
+	 # Helper methods
+	
+	def _run(self):
+		self._thread = _thread.get_ident()
+		asyncio.set_event_loop(self._loop)
+		self._loop.call_later(self._resolution, self._tick)
+		self._loop.run_forever()
+	
+	def _stop(self):
+		for conn in list(self._conns):
+			conn._connected = False
+			conn._inited.set()
+			self._detach(conn)
+		self._loop.stop()
+	
+	def _attach(self, conn):
+		if not conn._connected or self._conns.get(conn) is conn._sock:
+			return
+		self._detach(conn)
+		sock = conn._sock
+		sock.setblocking(False)
+		self._conns[conn] = sock
+		self._slots[conn] = self._slot
+		self._wheel[self._slot].add(conn)
+		self._loop.add_reader(sock, self._readable, conn, sock)
+		self._flush(conn)
+	
+	def _detach(self, conn):
+		sock = self._conns.pop(conn, None)
+		if sock is None:
+			return
+		self._wheel[self._slots.pop(conn)].discard(conn)
+		timer = self._timers.pop(conn, None)
+		if timer:
+			timer.cancel()
+		self._loop.remove_reader(sock)
+		self._loop.remove_writer(sock)
+		sock.close()
+	
+	def _lost(self, conn):
+		self._detach(conn)
+		if conn._connected:
+			_reconnects.schedule(conn)
+	
+	def _readable(self, conn, sock):
+		try:
+			read = conn._decoder.recv_into(sock)
+		except (BlockingIOError, InterruptedError):
+			return
+		except OSError:
+			read = 0
+		if not read:
+			self._lost(conn)
+			return
+		conn._bytes_in += read
+		conn._read_time = time.monotonic()
+		for data in conn._decoder.frames():
+			event, args = conn._parse(data)
+			try:
+				conn._handle(event, args)
+			except Exception as details:
+				_log.error(_get_tb())
+	
+	def _flush(self, conn):
+		sock = self._conns.get(conn)
+		if sock is None:
+			return
+		while True:
+			if not conn._outbuf:
+				data, wait = conn._writer.take()
+				if not data:
+					if wait and conn not in self._timers:
+						self._timers[conn] = self._loop.call_later(wait, self._timed_flush, conn)
 					break
-			if addq:
-				self._q.put({"event": "message", "message": msg, "room": self, "reply": lambda x: self.say(x)})
-		if len(self._history) > self._history_limit:
-			self._history = self._history[-self._history_limit:]
+				conn._outbuf += data
+			try:
+				sent = sock.send(conn._outbuf)
+			except (BlockingIOError, InterruptedError):
+				sent = 0
+			except OSError:
+				self._lost(conn)
+				return
+			del conn._outbuf[:sent]
+			if conn._outbuf:
+				# Wait for the socket to be writable again
+				self._loop.add_writer(sock, self._flush, conn)
+				return
+			conn._writer.written()
+		self._loop.remove_writer(sock)
 	
-	# -----------------------
-	 # Chatroom Event Handler
+	def _timed_flush(self, conn):
+		self._timers.pop(conn, None)
+		self._flush(conn)
 	
-	def _handle(self, event, args):
-		if event == "ok":
-			self._connected = True
-			self.admin = args[0]
-			self._user.uid = int(args[1])
-			self._user.logintime = float(args[4])
-			self._user.ip = args[5]
-			self._mods = args[6].split(";")
-			
-			if args[2] == "M":
-				self._user.type = chuser.REGD
-			elif args[2] == "C":
-				self._user.type = chuser.TEMP
-			elif args[2] == "N":
-				self._user.type = chuser.ANON
-		elif event == "denied":
-			self.disconnect()
-		elif event == "inited":
-			# Set up full name alerts and shit
-			self._send("g_participants:start")
-			# Get updated with the list of badwords
-			self._send("getbannedwords")
-			self._send("checkbannedwords")
-			# Check for premium status
-			self._send("getpremium", 1)
-			# Log in with a temp name if need be
-			if self._user.type == chuser.TEMP:
-				self._send("blogin", self._user.displayname)
-		elif event == "pwdok":
-			self._user.type = chuser.REGD
-			self._send("getpremium", 1)
-		elif event == "aliasok":
-			self._user.type = chuser.TEMP
-			self._send("getpremium", 1)
-		elif event == "logoutok":
-			self._user.type = chuser.ANON
-			self._send("getpremium", 1)
-		elif event =="show_fw" or event == "show_tb":
-			self._reconnect()
-		elif event == "ubw":
-			self._send("getbannedwords")
-		elif event == "bw":
-			bw = args[1]
-			if not bw:
-				self.badwords = []
-			else:
-				bw = urllib.parse.unquote(bw)
-				bw = bw.strip(",").split(",")
-				self.badwords = bw
-				special_chars = "\\.^$*+?{}[]|()"
-				self._bw_regx = []
-				for x in range(0, len(self.badwords)):
-					word = self.badwords[x]
-					for char in special_chars:
-						word = word.replace(char, "\\" + char)
-					self._bw_regx.append(word)
-		elif event == "premium":
-			if args[1] != '0':
-				self._premium = True
+	def _tick(self):
+		self._slot = (self._slot + 1) % len(self._wheel)
+		for conn in list(self._wheel[self._slot]):
+			try:
+				conn._send("")
+			except Exception as details:
+				_log.error(_get_tb())
+		self._loop.call_later(self._resolution, self._tick)
+
+# --------------------------------------------------------
+# Session for running lots of rooms under one set of creds
+# --------------------------------------------------------
+
+class session:
+	def __init__(self, username=None, password=None, engine=None, max_parallel=8, events=None):
+		'''Holds one set of credentials for any number of chatrooms
+		(and PMs), joins rooms concurrently, and puts all of their
+		events into one queue so there's only one place to wait on.
+		Leave out the password to join with a temporary name, or both
+		to join as an anon.
+
+		Ex: s = session("user", "pass", engine()); s.join_all(["room1", "room2"])'''
+		self._username = username
+		self._password = password
+		self._engine = engine
+		self._max_parallel = max(1, int(max_parallel))
+		self._q = events if events is not None else eventqueue()
+		self._rooms = {}
+		self._pms = None
+		self._lock = threading.Lock()
+		self.startup_times = {}
+
+	# ------------------
+	 # Interface methods
+
+	def auth(self, refresh=False):
+		'''Returns the auth token for the session's credentials. Tokens
+		are cached until they expire, see _get_auth().'''
+		if not (self._username and self._password):
+			raise InvalidCredentials
+		return _get_auth(self._username, self._password, refresh=refresh)
+
+	def join(self, name):
+		'''Join a chatroom, returning the chatroom object. Joining a
+		room that's already joined just returns it.'''
+		name = name.lower()
+		with self._lock:
+			room = self._rooms.get(name)
+			if room is None:
+				room = self._rooms[name] = chatroom(name, engine=self._engine, events=self._q)
+		if not room._connected:
+			start = time.monotonic()
+			try:
+				room.login(self._username, self._password)
+			except:
+				with self._lock:
+					if self._rooms.get(name) is room:
+						del self._rooms[name]
+				raise
+			self.startup_times[name] = time.monotonic() - start
+		return room
+
+	def join_all(self, names):
+		'''Join a bunch of chatrooms, up to max_parallel at a time.
+		Returns {name: chatroom}, with the exception instead for rooms
+		that couldn't be joined. How long each one took ends up in
+		startup_times.'''
+		names = [x.lower() for x in names]
+		results = {}
+		todo = collections.deque(names)
+		def worker():
+			while True:
+				try:
+					name = todo.popleft()
+				except IndexError:
+					return
+				try:
+					results[name] = self.join(name)
+				except Exception as details:
+					results[name] = details
+		workers = [threading.Thread(target=worker, daemon=True) for x in range(min(self._max_parallel, len(names)))]
+		for x in workers:
+			x.start()
+		for x in workers:
+			x.join()
+		return dict((x, results[x]) for x in names)
+
+	def leave(self, name):
+		'''Disconnect from a chatroom.'''
+		with self._lock:
+			room = self._rooms.pop(name.lower(), None)
+		if room and room._connected:
+			room.disconnect()
+
+	def get_room(self, name):
+		'''Returns the chatroom object for a joined room, or None.'''
+		return self._rooms.get(name.lower())
+
+	def rooms(self):
+		'''Returns a list of the joined chatroom objects.'''
+		return list(self._rooms.values())
+
+	def pms(self):
+		'''Log in to PMs with the session's credentials, once, and
+		return the pms object.'''
+		with self._lock:
+			if self._pms is None:
+				self._pms = pms(self._username, self._password, engine=self._engine, events=self._q)
+				self._pms.login()
+		return self._pms
+
+	def get_event(self, timeout=None):
+		'''Wait for the next event from any of the session's rooms or
+		PMs. See chatroom.get_event() and pms.get_event().'''
+		return self._q.get(timeout)
+
+	def get_events(self, max_n=100, timeout=None):
+		'''Wait for events from any of the session's rooms or PMs, then
+		return a list of up to max_n of them.'''
+		return self._q.get_events(max_n, timeout)
+
+	def disconnect(self):
+		'''Leave every room and log out of PMs.'''
+		for name in list(self._rooms):
+			self.leave(name)
+		if self._pms and self._pms._connected:
+			self._pms.disconnect()
+		self._pms = None
+
+# ------------------------------------------------------
+# Callbacks for events, run on a pool of worker threads
+# ------------------------------------------------------
+
+class dispatcher:
+	def __init__(self, events=None, threads=4, slow=1.0):
+		'''Calls handlers for events instead of leaving them for
+		get_event(). Give it a session, supervisor or chatroom, or the
+		eventqueue their events go to (a new one by default, see
+		dispatcher.events), and don't call get_event() on it as well.
+		Handlers run on a pool of threads: each
+		room's (or the PMs') events are handled one at a time in order,
+		while different rooms go in parallel. Reading the sockets never
+		waits on a handler. Any handler taking more than slow seconds
+		is logged as a warning (again every slow seconds while it keeps
+		going) and counted in stats().
+
+		Handlers are added with on(), or as on_<event> methods of a
+		subclass, and get the event (see chatroom.get_event()).
+
+		Ex: d = dispatcher(s); d.on("message", lambda x: print(x["message"].content))'''
+		events = getattr(events, "_q", events)
+		self.events = events if events is not None else eventqueue()
+		self.slow = slow
+		self._handlers = collections.defaultdict(list)
+		self._waiting = {}
+		self._ready = queue.Queue()
+		self._lock = threading.Lock()
+		self._running = {}
+		self._slow = {}
+		self._handled = 0
+		self._errors = 0
+		self._stopped = False
+		self._threads = [threading.Thread(target=self._pump, daemon=True), threading.Thread(target=self._watch, daemon=True)]
+		self._threads.extend(threading.Thread(target=self._work, daemon=True) for x in range(max(1, int(threads))))
+		for thread in self._threads:
+			thread.start()
+
+	# ------------------
+	 # Interface methods
+
+	def on(self, event, func=None):
+		'''Call func(event) for every event of this type ("message",
+		"login", ...; "*" for all of them). Works as a decorator too.
+
+		Ex: @d.on("message")'''
+		if func is None:
+			return lambda func: self.on(event, func) or func
+		with self._lock:
+			self._handlers[event].append(func)
+
+	def off(self, event, func):
+		'''Stop calling func for this type of event.'''
+		with self._lock:
+			if func in self._handlers.get(event, ()):
+				self._handlers[event].remove(func)
+
+	def stats(self):
+		'''Returns how many events have been handled, how many handlers
+		raised, how many events are waiting, and {handler name: [times
+		slow, worst seconds]} for the slow ones.'''
+		with self._lock:
+			return {
+				"handled": self._handled,
+				"errors": self._errors,
+				"waiting": len(self.events) + sum(len(x) for x in self._waiting.values()),
+				"slow": dict((x, list(y)) for x, y in self._slow.items()),
+			}
+
+	def stop(self):
+		'''Stop handling events once the ones being handled are done.
+		Anything still waiting is left alone.'''
+		self._stopped = True
+		# A dummy event wakes up the pump, and one key each the workers
+		self.events.put(chevent(event=None))
+		for thread in self._threads[2:]:
+			self._ready.put(None)
+		for thread in self._threads[2:]:
+			thread.join()
+
+	# ---------------
+	 # Helper methods
+
+	def _pump(self):
+		# Sort events by where they came from; a room already queued up
+		# or being handled just gets them added to its line
+		while not self._stopped:
+			batch = self.events.get_events(500)
+			with self._lock:
+				for event in batch:
+					key = event.get("room") or event.get("pms")
+					line = self._waiting.get(key)
+					if line is None:
+						line = self._waiting[key] = collections.deque()
+						self._ready.put(key)
+					line.append(event)
+
+	def _work(self):
+		# Take a room and handle its events, giving it back after a few so
+		# one busy room can't keep a thread to itself
+		me = threading.get_ident()
+		while True:
+			key = self._ready.get()
+			if self._stopped:
+				return
+			line = self._waiting[key]
+			for x in range(_DISPATCH_BATCH):
+				with self._lock:
+					if not line:
+						del self._waiting[key]
+						break
+					event = line.popleft()
+					self._handled += 1
+				self._dispatch(me, event)
 			else:
-				self._premium = False
-		elif event == "n":
-			self.size = int(args[0], 16)
-		elif event == "mods":
-			self._mods = args
-		elif event == "b" or event == "i":
-			posttime, reg_name, tmp_name, uid, umid, index, ip, x = args[:8]
-			msg = ":".join(args[8:])
-			ts = re.findall("^<n(\d+)/>", msg)
-			ts = ts[0] if ts else ""
-			
-			if reg_name == tmp_name == "":
-				user_type = chuser.ANON
-				username = ""
-			elif reg_name == "":
-				user_type = chuser.TEMP
-				username = tmp_name
+				self._ready.put(key)
+
+	def _dispatch(self, me, event):
+		name = event["event"]
+		if name is None:
+			return
+		with self._lock:
+			handlers = self._handlers.get(name, []) + self._handlers.get("*", [])
+		method = getattr(self, "on_" + name, None)
+		if method is not None:
+			handlers.append(method)
+		for func in handlers:
+			start = time.monotonic()
+			self._running[me] = [func, event, start, start]
+			try:
+				func(event)
+			except Exception:
+				with self._lock:
+					self._errors += 1
+				_log.error(_get_tb())
+			took = time.monotonic() - start
+			del self._running[me]
+			if took > self.slow:
+				self._slowed(func, took)
+
+	def _watch(self):
+		# Report handlers that are still going after slow seconds, and then
+		# every slow seconds until they're done
+		while not self._stopped:
+			time.sleep(max(self.slow / 4, 0.05))
+			now = time.monotonic()
+			for running in list(self._running.values()):
+				func, event, start, reported = running
+				if now - reported > self.slow:
+					running[3] = now
+					_log.warning("%s still handling %s event after %.1fs", _handler_name(func), event["event"], now - start)
+
+	def _slowed(self, func, took):
+		name = _handler_name(func)
+		with self._lock:
+			slow = self._slow.get(name)
+			if slow is None:
+				slow = self._slow[name] = [0, 0.0]
+			slow[0] += 1
+			slow[1] = max(slow[1], took)
+		_log.warning("%s took %.3fs", name, took)
+
+# ---------------------------------------------------
+# Supervisor spreading chatrooms over worker processes
+# ---------------------------------------------------
+
+class supervisor:
+	def __init__(self, username=None, password=None, processes=None, events=None):
+		'''Runs chatrooms in a pool of worker processes (one per CPU by
+		default), each with its own session and engine, so parsing and
+		everything else isn't stuck under one GIL. Rooms are given to
+		workers by chatango server when they're joined, and stay there
+		whatever set_server_weights() changes later (which workers pick
+		up too). Every worker's events come back into one queue here.
+		Rooms are handed out as shardroom objects, which pass say(),
+		ban() and the rest on to the worker running the room. Only
+		chatrooms are sharded; use a session for PMs.
+
+		Scripts using this need the usual if __name__ == "__main__":
+		guard, since workers are started fresh and import the script.
+
+		Ex: s = supervisor("user", "pass"); s.join_all(["room1", "room2"])'''
+		context = multiprocessing.get_context("spawn")
+		self._q = events if events is not None else eventqueue()
+		self._rooms = {}
+		self._lock = threading.Lock()
+		self._workers = []
+		for x in range(processes or os.cpu_count() or 1):
+			conn, child = context.Pipe()
+			process = context.Process(target=_shard_main, args=(child, username, password, _server_override, _server_weights), daemon=True)
+			process.start()
+			child.close()
+			worker = _shardworker(x, process, conn)
+			self._workers.append(worker)
+			threading.Thread(target=self._read, args=(worker,), daemon=True).start()
+		_supervisors.add(self)
+
+	# ------------------
+	 # Interface methods
+
+	def join(self, name):
+		'''Join a chatroom in whichever worker its server belongs to,
+		returning a shardroom.'''
+		name = name.lower()
+		worker = self._worker(name)
+		self._request(worker, "join", name)
+		return self._room(name, worker)
+
+	def join_all(self, names):
+		'''Join a bunch of chatrooms, every worker joining its share at
+		once. Returns {name: shardroom}, with the exception instead for
+		rooms that couldn't be joined.'''
+		names = [x.lower() for x in names]
+		shares = collections.defaultdict(list)
+		for name in names:
+			shares[self._worker(name)].append(name)
+		results = {}
+		def join(worker, share):
+			try:
+				errors = self._request(worker, "join_all", share)
+			except Exception as details:
+				errors = dict((x, (type(details).__name__, str(details))) for x in share)
+			for name in share:
+				results[name] = _shard_error(*errors[name]) if name in errors else self._room(name, worker)
+		threads = [threading.Thread(target=join, args=x, daemon=True) for x in shares.items()]
+		for x in threads:
+			x.start()
+		for x in threads:
+			x.join()
+		return dict((x, results[x]) for x in names)
+
+	def leave(self, name):
+		'''Disconnect from a chatroom.'''
+		name = name.lower()
+		worker = self._worker(name)
+		with self._lock:
+			self._rooms.pop(name, None)
+		self._request(worker, "leave", name)
+
+	def get_room(self, name):
+		'''Returns the shardroom for a joined room, or None.'''
+		return self._rooms.get(name.lower())
+
+	def rooms(self):
+		'''Returns a list of the joined rooms' shardroom objects.'''
+		return list(self._rooms.values())
+
+	def get_event(self, timeout=None):
+		'''Wait for the next event from any room in any worker. Events
+		are the same as chatroom.get_event()'s, with a shardroom in
+		place of the chatroom.'''
+		return self._q.get(timeout)
+
+	def get_events(self, max_n=100, timeout=None):
+		'''Wait for events from any room in any worker, then return a
+		list of up to max_n of them.'''
+		return self._q.get_events(max_n, timeout)
+
+	def stop(self):
+		'''Leave every room and shut the workers down.'''
+		for worker in self._workers:
+			try:
+				worker.send((0, "stop", None))
+			except OSError:
+				pass
+		for worker in self._workers:
+			worker.process.join(5)
+			if worker.process.is_alive():
+				worker.process.terminate()
+			worker.conn.close()
+		self._rooms.clear()
+		_supervisors.discard(self)
+
+	# ---------------
+	 # Helper methods
+
+	def _worker(self, name):
+		# A joined room stays with the worker it was joined in, even if
+		# the server weights have changed since
+		room = self._rooms.get(name)
+		if room is not None:
+			return room._worker
+		return self._workers[_get_server_num(name) % len(self._workers)]
+
+	def _room(self, name, worker=None):
+		with self._lock:
+			room = self._rooms.get(name)
+			if room is None:
+				room = self._rooms[name] = shardroom(self, name, worker or self._worker(name))
+			return room
+
+	def _watch(self, event):
+		# The flood detector and directory are this process's, not the
+		# workers', so they're fed from the events coming back. That way
+		# floods are still caught across every worker's rooms.
+		name = event.get("event")
+		room = event.get("room")
+		if name == "message":
+			msg = event["message"]
+			if _directory is not None:
+				_directory.see(msg.user, room.name, msg.posttime, msg.umid)
+			if _flood is not None:
+				for kind, posts in _flood.check(msg, room.name):
+					self._q.put(chevent(event="flood", room=room, **_flood_details(kind, posts)))
+		elif name == "login" and _directory is not None:
+			_directory.see(event["user"], room.name)
+		elif name == "nickchange" and _directory is not None and event["new"].type != chuser.ANON:
+			_directory.see(event["new"], room.name)
+
+	def _set_weights(self):
+		# Pass a change of server weights on to the workers
+		for worker in self._workers:
+			try:
+				worker.send((0, "weights", _server_weights))
+			except OSError:
+				pass
+
+	def _request(self, worker, command, args):
+		# Send a command and wait for the worker to say how it went
+		waiter = [threading.Event(), None]
+		with worker.lock:
+			worker.count += 1
+			cid = worker.count
+			worker.pending[cid] = waiter
+		try:
+			worker.send((cid, command, args))
+		except OSError:
+			worker.pending.pop(cid, None)
+			raise NotConnected
+		waiter[0].wait()
+		ok, value = waiter[1]
+		if not ok:
+			raise _shard_error(*value)
+		return _unpack(value, self._room)
+
+	def _read(self, worker):
+		# Sort what a worker sends back into events and replies
+		while True:
+			try:
+				data = worker.conn.recv_bytes()
+			except (EOFError, OSError):
+				break
+			kind, body = marshal.loads(data)
+			if kind == _SHARD_EVENTS:
+				for packed in body:
+					event = chevent((x, _unpack(y, self._room)) for x, y in packed)
+					if _flood is not None or _directory is not None:
+						self._watch(event)
+					self._q.put(event)
 			else:
-				user_type = chuser.REGD
-				username = reg_name
-			
-			plaintext = re.sub("<[^>]+>", "", msg)
-			plaintext = _unescape(plaintext)
-			
-			u = chuser(username=username, uid=uid, umid=umid, ip=ip, type=user_type, ts=ts)
-			msg = chmessage(posttime=posttime, formatted=msg, content=plaintext, umid=umid, index=index, user=u)
-			
-			if event == "b":
-				msg.type = chmessage.NEW
-				self._noid_messages[msg.index] = msg
-			elif event == "i":
-				msg.type = chmessage.HISTORY
-				del msg.index
-				msg.mid = index
-				self._add_history(msg)
-		elif event == "u":
-			index, mid = args
-			msg = self._noid_messages.get(index)
-			if msg:
-				self._noid_messages.pop(msg.index)
-				msg.mid = mid
-				self._add_history(msg)
-		elif event == "g_participants":
-			args = ":".join(args)
-			args = args.split(";")
-			for infoz in args:
-				session, logintime, uid, reg_name, tmp_name, null = infoz.split(":")
-				
-				# Determine the user type before doing anything else, reducing unecessary overhead
-				if reg_name == tmp_name == "None":
-					user_type = chuser.ANON
-					username = ""
-				elif reg_name == "None":
-					user_type = chuser.TEMP
-					username = tmp_name
-				else:
-					user_type = chuser.REGD
-					username = reg_name
-				
-				if user_type == chuser.REGD:
-					u = chuser(session=session, uid=uid, logintime=logintime, username=username, type=user_type)
-					self._online.append(u)
-		elif event == "participant":
-			p_event, session, uid, reg_name, tmp_name, ip, logintime = args
-			session = int(session)
-			
-			# Determine the user type before doing anything else, reducing unecessary overhead
-			if reg_name == tmp_name == "None":
-				user_type = chuser.ANON
-				username = ""
-			elif reg_name == "None":
-				user_type = chuser.TEMP
-				username = tmp_name
+				cid, ok, value = body
+				waiter = worker.pending.pop(cid, None)
+				if waiter:
+					waiter[1] = (ok, value)
+					waiter[0].set()
+		# The worker's gone, so nothing waiting on it is getting an answer
+		for cid in list(worker.pending):
+			waiter = worker.pending.pop(cid)
+			waiter[1] = (False, ("NotConnected", "worker %i exited" % worker.number))
+			waiter[0].set()
+
+class shardroom:
+	def __init__(self, owner, name, worker):
+		'''Stands in for a chatroom running in one of a supervisor's
+		workers. The moderation and chat methods are passed on to it
+		without waiting; call() runs anything else there and returns
+		the result.'''
+		self.name = name
+		self._owner = owner
+		self._worker = worker
+
+	def say(self, msg, raw=True):
+		'''See chatroom.say().'''
+		self._post("say", _to_str(msg), raw)
+
+	def ban(self, user):
+		'''See chatroom.ban().'''
+		self._post("ban", user)
+
+	def unban(self, user):
+		'''See chatroom.unban().'''
+		self._post("unban", user)
+
+	def delete(self, msg):
+		'''See chatroom.delete().'''
+		self._post("delete", msg)
+
+	def deleteall(self, username):
+		'''See chatroom.deleteall().'''
+		self._post("deleteall", username)
+
+	def call(self, method, *args):
+		'''Call a chatroom method in the worker and return what it
+		returned. Messages, users and rooms come back as copies.
+
+		Ex: room.call("get_online")'''
+		return self._owner._request(self._worker, "call", (self.name, method, _pack(args)))
+
+	def disconnect(self):
+		'''Leave the chatroom.'''
+		self._owner.leave(self.name)
+
+	def _post(self, method, *args):
+		self._worker.send((0, "call", (self.name, method, _pack(args))))
+
+class _shardworker:
+	def __init__(self, number, process, conn):
+		self.number = number
+		self.process = process
+		self.conn = conn
+		self.lock = threading.Lock()
+		self.count = 0
+		self.pending = {}
+
+	def send(self, command):
+		data = marshal.dumps(command)
+		with self.lock:
+			self.conn.send_bytes(data)
+
+def _shard_main(conn, username, password, server, weights):
+	# Runs in each worker: a session on an engine, fed commands from the
+	# supervisor, sending events back in batches
+	global _server_override
+	_server_override = server
+	set_server_weights(weights["weights"], weights["specials"])
+	events = eventqueue()
+	s = session(username, password, engine(), events=events)
+	lock = threading.Lock()
+	def send(data):
+		data = marshal.dumps(data)
+		with lock:
+			conn.send_bytes(data)
+	def pump():
+		while True:
+			batch = events.get_events(500)
+			try:
+				send((_SHARD_EVENTS, [[(x, _pack(y)) for x, y in event.items()] for event in batch]))
+			except OSError:
+				return
+	def run(cid, command, args):
+		try:
+			if command == "join":
+				s.join(args)
+				result = None
+			elif command == "join_all":
+				result = dict((x, (type(y).__name__, str(y))) for x, y in s.join_all(args).items() if isinstance(y, Exception))
+			elif command == "leave":
+				result = s.leave(args)
+			elif command == "weights":
+				result = set_server_weights(args["weights"], args["specials"])
 			else:
-				user_type = chuser.REGD
-				username = reg_name
-			
-			u = chuser(session=session, uid=uid, username=username, type=user_type, logintime=logintime, ip=ip)
-			
-			if p_event == "0":
-				# The user logged out
-				for user_ in self._online:
-					if user_.session == session:
-						self._online.remove(user_)
-						if user_.type == chuser.REGD:
-							self._q.put({"event": "logout", "username": u.username, "user": u, "room": self, "reply": lambda x: self.say(x)})
-			elif p_event == "1":
-				# The user logged in
-				self._online.append(u)
-				if u.type == chuser.REGD:
-					self._q.put({"event": "login", "username": u.username, "user": u, "room": self, "reply": lambda x: self.say(x)})
-			elif p_event == "2":
-				for user_ in self._online:
-					if user_.session == session:
-						self._online.remove(user_)
-						self._online.append(u)
-						self._q.put({"event": "nickchange", "old": user_, "new": u, "room": self, "reply": lambda x: self.say(x)})
+				name, method, args = args
+				room = s.get_room(name)
+				if room is None:
+					raise NotConnected("not in %s" % name)
+				result = getattr(room, method)(*_unpack(args))
+		except Exception as details:
+			if not cid:
+				_log.error(_get_tb())
+				return
+			reply = (cid, False, (type(details).__name__, str(details)))
+		else:
+			if not cid:
+				return
+			reply = (cid, True, _pack(result))
+		try:
+			send((_SHARD_REPLY, reply))
+		except OSError:
+			pass
+	threading.Thread(target=pump, daemon=True).start()
+	while True:
+		try:
+			cid, command, args = marshal.loads(conn.recv_bytes())
+		except (EOFError, OSError):
+			break
+		if command == "stop":
+			break
+		if cid:
+			# Anyone waiting on an answer gets their own thread, so a slow join holds nothing up
+			threading.Thread(target=run, args=(cid, command, args), daemon=True).start()
+		else:
+			run(cid, command, args)
+	s.disconnect()
 
 # --------------
 # HELPER METHODS
@@ -865,7 +3743,10 @@ def _anon_name(uid, ts=None):
 	return "Anon" + aid
 
 def _get_server_num(name):
-	roomname = name.lower()
+	return _server_num(name.lower())
+
+@functools.lru_cache(maxsize=65536)
+def _server_num(roomname):
 	server = _server_weights['specials'].get(roomname)
 	
 	if not server:
@@ -881,28 +3762,60 @@ def _get_server_num(name):
 		else:
 			if r7 <= 1000: r7 = 1000
 		
-		r4 = 0
-		r5 = {}
-		r6 = sum([x[1] for x in _server_weights["weights"]])
-		
-		for x in range(0, len(_server_weights["weights"])):
-			r4 = r4 + _server_weights["weights"][x][1] / r6
-			r5[_server_weights["weights"][x][0]] = r4
-		
-		for x in range(0, len(_server_weights["weights"])):
-			if ((base36 % r7 / r7) <= r5[_server_weights["weights"][x][0]]):
-				server = _server_weights["weights"][x][0];
-				break
+		# First server whose share of the cumulative weights covers this room
+		cumulative, servers = _server_table
+		x = bisect.bisect_left(cumulative, base36 % r7 / r7)
+		server = servers[min(x, len(servers) - 1)]
 	
 	return int(server)
 
-def _get_auth(username, password):		
-	data = urllib.parse.urlencode({'user_id' : username, 'password' : password, 'storecookie' : 'on', 'checkerrors' : 'yes'})
-	while 1:
+def _build_server_table(weights):
+	# Cumulative fractions of the total weight, in the same order chatango adds them up
+	r4 = 0
+	r6 = sum([x[1] for x in weights])
+	cumulative = []
+	for server, weight in weights:
+		r4 = r4 + weight / r6
+		cumulative.append(r4)
+	return cumulative, [x[0] for x in weights]
+
+def resolve_servers(names):
+	'''Returns {name: server number} for a bunch of room names, the
+	number being the N in sN.chatango.com.'''
+	return dict((x, _server_num(x.lower())) for x in names)
+
+def set_server_weights(weights=None, specials=None):
+	'''Replace the table used to work out which server a room is on.
+	weights is a list of [server number, weight] pairs and specials a
+	dict of {room name: server number} for rooms that don't follow
+	the weights. Leave either out to keep the current one.'''
+	global _server_table
+	if weights is not None:
+		_server_weights["weights"] = [[str(x), int(y)] for x, y in weights]
+		_server_table = _build_server_table(_server_weights["weights"])
+	if specials is not None:
+		_server_weights["specials"] = dict((x.lower(), int(y)) for x, y in specials.items())
+	_server_num.cache_clear()
+	for owner in list(_supervisors):
+		owner._set_weights()
+
+def _get_auth(username, password, refresh=False, ttl=3600, tries=5):
+	'''Log in over http and return the auth token, or None if the
+	credentials are wrong. Tokens are cached for ttl seconds unless
+	refresh is set. Failed requests are retried with exponential
+	backoff, raising NotConnected after tries attempts.'''
+	key = (username.lower(), password)
+	cached = _auth_cache.get(key)
+	if cached and not refresh and cached[1] > time.monotonic():
+		return cached[0]
+	data = urllib.parse.urlencode({'user_id' : username, 'password' : password, 'storecookie' : 'on', 'checkerrors' : 'yes'}).encode()
+	for attempt in range(tries):
 		try:
-			headers = urllib.request.urlopen('http://chatango.com/login', data).headers.items()
-		except:
-			continue
+			headers = urllib.request.urlopen('http://chatango.com/login', data, timeout=30).headers.items()
+		except Exception as details:
+			if attempt == tries - 1:
+				raise NotConnected(details)
+			time.sleep(min(30, 2 ** attempt) * random.uniform(0.5, 1.5))
 		else:
 			break
 	auth = None
@@ -910,33 +3823,264 @@ def _get_auth(username, password):
 		if header[0] == 'Set-Cookie' and header[1].startswith('auth.chatango.com'):
 			auth = header[1].split('=')[1].split(';')[0]
 	if not auth:
+		_auth_cache.pop(key, None)
 		return None
 	else:
+		_auth_cache[key] = (auth, time.monotonic() + ttl)
 		return auth
 
+def _message_text(formatted):
+	'''Turn the html of a message into plain text.'''
+	if "<" in formatted:
+		formatted = _tag_regx.sub("", formatted.replace("</P><P>", "\n"))
+	return _unescape(formatted)
+
+def _message_font(formatted):
+	'''Returns the name color, font color, font size and font face
+	used at the start of a message, with None for any that aren't set.'''
+	head = _head_regx.match(formatted)
+	face = head.group(4)
+	size = head.group(2)
+	return head.group(1), head.group(3), int(size) if size else None, _font_family_nums.get(face, face) if face else None
+
 def _unescape(text):
-	text = text.replace("&apos;", "'")
-	text = text.replace("&quot;", '"')
-	text = text.replace("&amp;", "&")
-	def fixup(m):
-		text = m.group(0)
-		if text[:2] == "&#":
-			# character reference
-			try:
-				if text[:3] == "&#x":
-					return chr(int(text[3:-1], 16))
-				else:
-					return chr(int(text[2:-1]))
-			except ValueError:
-				pass
-		else:
-			# named entity
-			try:
-				text = chr(html.entities.name2codepoint[text[1:-1]])
-			except KeyError:
-				pass
-		return text # leave as is
-	return re.sub("&#?\w+;", fixup, text)
+	if "&" not in text:
+		return text
+	return _entity_regx.sub(_entity, text)
+
+def _entity(m):
+	text = m.group(1)
+	if text[0] == "#":
+		# character reference
+		try:
+			if text[1] in "xX":
+				return chr(int(text[2:], 16))
+			else:
+				return chr(int(text[1:]))
+		except (ValueError, OverflowError):
+			return m.group(0) # leave as is
+	# named entity
+	return _entities.get(text, m.group(0))
+
+def _word_pattern(words):
+	'''Compile a case insensitive pattern matching any of the given
+	words. The words are merged into a trie first, so matching costs
+	about the same however many words there are.'''
+	trie = {}
+	for word in words:
+		if word:
+			node = trie
+			for char in word.lower():
+				node = node.setdefault(char, {})
+			node[""] = None
+	if not trie:
+		return None
+	def build(node):
+		branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+		if not branches:
+			return ""
+		if len(branches) == 1 and "" not in node:
+			return branches[0]
+		return "(?:%s)%s" % ("|".join(branches), "?" if "" in node else "")
+	return re.compile(build(trie), re.IGNORECASE)
+
+def _filterorder(rule):
+	return rule.order
+
+def _scoped_pattern(regx):
+	# A regex's pattern, with its flags applying only to itself
+	flags = "".join(x for x, y in (("i", re.IGNORECASE), ("m", re.MULTILINE), ("s", re.DOTALL), ("x", re.VERBOSE)) if regx.flags & y)
+	return "(?%s:%s)" % (flags, regx.pattern)
+
+def _filtercontent(prefilter, msg):
+	# Whether any of the merged regexes are found in a message
+	if prefilter is None:
+		return True
+	content = msg.content or ""
+	for regx in prefilter:
+		if regx.search(content):
+			return True
+	return False
+
+def _sketch_similarity(a, b, size, similarity):
+	# Whether two bottom-k MinHash sketches (a set and a sorted tuple)
+	# look at least similarity alike, estimating their Jaccard
+	# similarity as the share of the smallest size hashes of both that
+	# are in each
+	both = a.intersection(b)
+	if len(both) < similarity * min(size, max(len(a), len(b))):
+		return False
+	union = sorted(a.union(b))[:size]
+	return sum(1 for x in union if x in both) >= similarity * len(union)
+
+def _pack(value):
+	# Turn messages, users and rooms into plain tuples marshal can carry
+	if isinstance(value, chmessage):
+		return (_PACK_MESSAGE, value.posttime, _pack(value.user), value.formatted, value.mid, value.umid, getattr(value, "index", None), value.type)
+	if isinstance(value, chuser):
+		return (_PACK_USER, value._username, value._ts, value.uid, value.umid, value.session, value.logintime, value.type, value.ip)
+	if isinstance(value, (chatroom, shardroom)):
+		return (_PACK_ROOM, value.name)
+	if isinstance(value, (list, tuple, set, frozenset)):
+		return (_PACK_LIST, [_pack(x) for x in value])
+	if isinstance(value, dict):
+		return (_PACK_DICT, [(_pack(x), _pack(y)) for x, y in value.items()])
+	if value is None or isinstance(value, (str, int, float, bytes)):
+		return (_PACK_PLAIN, value)
+	return (_PACK_PLAIN, repr(value))
+
+def _unpack(value, room=None):
+	kind = value[0]
+	if kind == _PACK_PLAIN:
+		return value[1]
+	if kind == _PACK_MESSAGE:
+		return chmessage(posttime=value[1], user=_unpack(value[2]), formatted=value[3], mid=value[4], umid=value[5], index=value[6], type=value[7])
+	if kind == _PACK_USER:
+		return chuser(username=value[1], ts=value[2], uid=value[3], umid=value[4], session=value[5], logintime=value[6], type=value[7], ip=value[8])
+	if kind == _PACK_ROOM:
+		return room(value[1]) if room else value[1]
+	if kind == _PACK_LIST:
+		return [_unpack(x, room) for x in value[1]]
+	return dict((_unpack(x, room), _unpack(y, room)) for x, y in value[1])
+
+def _shard_error(name, text):
+	# Rebuild an exception raised in a worker, as one of ours where possible
+	if name in ("InvalidCredentials", "KickedOff", "NotConnected"):
+		return globals()[name](text)
+	return NotConnected("%s: %s" % (name, text))
+
+def _split_message(text, limit, widths=None):
+	# Cut text into pieces of at most limit characters: at the last
+	# newline, space or tag boundary before the limit, else right at it,
+	# but never inside a tag or an entity. widths gives the length of
+	# characters that count as more than one (like a PM's newlines and
+	# tabs once wrapped). A boundary in the first half of the piece would
+	# leave it next to empty (like just "<b>"), so that's cut right at the
+	# limit too. No piece, the last included, is left under half the
+	# limit, bar backing off a tag or entity the cut would land in.
+	left = _message_size(text, 0, len(text), widths)
+	if left <= limit:
+		return [text]
+	# Room for the newline or space a cut drops, so it doesn't come out
+	# of the last piece
+	gap = widths.get("\n", 1) if widths else 1
+	pieces = []
+	start = 0
+	while left > limit:
+		stop = max(_message_reach(text, start, min(limit, left - limit // 2 - gap), widths), start + 1)
+		least = max(_message_reach(text, start, limit // 2, widths), start + 1)
+		cut = text.rfind("\n", least, stop + 1)
+		if cut == -1:
+			cut = max(text.rfind(" ", start + 1, stop + 1), text.rfind("<", start + 1, stop + 1), text.rfind(">", start, stop) + 1)
+		if cut < least:
+			cut = stop
+			amp = text.rfind("&", max(start + 1, stop - 10), stop)
+			if amp != -1 and text.find(";", amp, stop) == -1:
+				cut = amp
+		tag = text.rfind("<", start + 1, cut)
+		if tag > text.rfind(">", start, cut):
+			cut = tag
+		pieces.append(text[start:cut])
+		if text[cut] in " \n":
+			cut += 1
+		left -= _message_size(text, start, cut, widths)
+		start = cut
+	if start < len(text):
+		pieces.append(text[start:])
+	return pieces
+
+def _message_size(text, start, stop, widths):
+	# How long text[start:stop] comes out, given the widths of characters
+	# that count as more than one
+	size = stop - start
+	if widths:
+		for char, width in widths.items():
+			size += text.count(char, start, stop) * (width - 1)
+	return size
+
+def _message_reach(text, start, size, widths):
+	# Where a piece of text from start that's at most size long ends
+	stop = min(start + size, len(text))
+	if widths and _message_size(text, start, stop, widths) > size:
+		low = start
+		while low < stop:
+			middle = (low + stop + 1) // 2
+			if _message_size(text, start, middle, widths) > size:
+				stop = middle - 1
+			else:
+				low = middle
+	return stop
+
+def _flood_details(kind, posts):
+	# What a flood event says about the posts behind it
+	users = []
+	for post in posts:
+		if post[1] not in users:
+			users.append(post[1])
+	return {"kind": kind, "users": users, "mids": [x[2] for x in posts], "rooms": sorted(set(x[3] for x in posts))}
+
+def _handler_name(func):
+	return getattr(func, "__qualname__", None) or repr(func)
+
+def _pm_body(msg):
+	# Put a PM's text in the paragraphs and tab padding chatango wants
+	msg = _to_str(msg).replace("\t", " \x01 \x01 \x01 \x01")
+	return "<P>" + msg.replace("\n", "</P><P>") + "</P>"
+
+def _participant_type(reg_name, tmp_name):
+	# The type and name of someone in a participant list
+	if reg_name == tmp_name == "None":
+		return chuser.ANON, ""
+	elif reg_name == "None":
+		return chuser.TEMP, tmp_name
+	return chuser.REGD, reg_name
+
+def _participant_entries(data):
+	# Yield each entry of a g_participants list as it's reached, instead
+	# of splitting the whole thing up front
+	start = 0
+	end = len(data)
+	while start < end:
+		stop = data.find(";", start)
+		if stop < 0:
+			stop = end
+		if stop > start:
+			yield data[start:stop].split(":", 5)[:5]
+		start = stop + 1
+
+def _close(sock):
+	# Shut down first, so a thread blocked reading it wakes up
+	try:
+		sock.shutdown(socket.SHUT_RDWR)
+	except OSError:
+		pass
+	sock.close()
+
+def _map(path):
+	# Memory map a file for reading, None if it's empty or missing
+	try:
+		with open(path, "rb") as f:
+			return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+	except (OSError, ValueError):
+		return None
+
+def _archive_hash(data):
+	return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
+
+def _archive_read(log_map, offset):
+	posttime, user_type, uid, mid, name, umid, ip, formatted = _archive_record.unpack_from(log_map, offset)
+	offset += _archive_record.size
+	fields = []
+	for size in (mid, name, umid, ip, formatted):
+		fields.append(log_map[offset:offset + size].decode("utf-8", "replace"))
+		offset += size
+	mid, name, umid, ip, formatted = fields
+	ts = _head_regx.match(formatted).group(1) or ""
+	user = chuser(username=name, uid=uid, umid=umid or None, ip=ip or None, type=user_type, ts=ts if ts.isdigit() else "")
+	return chmessage(posttime=posttime, user=user, formatted=formatted, mid=mid or None, umid=umid or None, type=chmessage.HISTORY)
+
+def _posttime(msg):
+	return msg.posttime
 
 def _to_str(obj):
 	'''Manipulate any data type to safely be a string'''
@@ -959,11 +4103,132 @@ def _get_tb():
 	except Exception as details:
 		print(details)
 
+def limit_sends(rate=None, burst=None):
+	'''Control how many frames a second can be sent over all connections
+	put together (None for no limit), on top of any per connection limit.'''
+	global _send_limit
+	_send_limit = ratelimit(rate, burst) if rate else None
+
+def set_directory(directory):
+	'''Record everyone seen posting or joining in any chatroom in the
+	given chdirectory (None to stop). Rooms run by a supervisor are
+	recorded in the supervisor's process, from the message and login
+	events its workers send back, so anons joining aren't seen, and
+	neither are messages their rooms ignore. Returns the directory.'''
+	global _directory
+	_directory = directory
+	return directory
+
+def get_directory():
+	'''Returns the chdirectory set with set_directory(), or None.'''
+	return _directory
+
+def set_flood_detector(detector):
+	'''Check every new message in any chatroom with the given
+	flooddetector (None to stop), chatrooms emitting a "flood" event
+	with the kind of flood, the users and mids of the messages behind
+	it and the rooms they were in. Rooms run by a supervisor are checked
+	in the supervisor's process as their messages come back, across all
+	of its workers, and the supervisor emits the "flood" events.
+	Messages those rooms ignore never get back, so aren't counted.
+	Returns the detector.'''
+	global _flood
+	_flood = detector
+	return detector
+
+def use_server(host=None, port=443):
+	'''Send every new connection to host:port instead of chatango's
+	servers, like a local stand in for testing. None to go back.'''
+	global _server_override
+	_server_override = (host, port) if host else None
+
+def reconnect_policy(base=1, cap=300, jitter=0.5, per_server=4, stable=60):
+	'''Control how dropped connections are reconnected, see reconnector.'''
+	_reconnects.base = base
+	_reconnects.cap = cap
+	_reconnects.jitter = jitter
+	_reconnects.per_server = per_server
+	_reconnects.stable = stable
+
+def prometheus_metrics(conns):
+	'''Returns the metrics() of a bunch of chatrooms and pms, in the
+	Prometheus text format, labelled with the room name (or PMS).
+
+	Ex: prometheus_metrics(session.rooms())'''
+	conns = [(_label(x._tag), x.metrics()) for x in conns]
+	lines = []
+	for name, kind, key, help in _prometheus_metrics:
+		lines.append("# HELP chatango_%s %s" % (name, help))
+		lines.append("# TYPE chatango_%s %s" % (name, kind))
+		for tag, metrics in conns:
+			if key not in metrics:
+				# Only chatrooms have some
+				continue
+			if kind == "summary":
+				lines.append('chatango_%s_sum{connection="%s"} %r' % (name, tag, metrics[key] * metrics["events_delivered"]))
+				lines.append('chatango_%s_count{connection="%s"} %i' % (name, tag, metrics["events_delivered"]))
+			else:
+				lines.append('chatango_%s{connection="%s"} %r' % (name, tag, metrics[key]))
+	for name, column, help in (("commands_total", 0, "Commands handled."), ("command_seconds_total", 1, "Time spent handling commands.")):
+		lines.append("# HELP chatango_%s %s" % (name, help))
+		lines.append("# TYPE chatango_%s counter" % name)
+		for tag, metrics in conns:
+			for command, stats in sorted(metrics["commands"].items()):
+				lines.append('chatango_%s{connection="%s",command="%s"} %r' % (name, tag, _label(command), stats[column]))
+	return "\n".join(lines) + "\n"
+
+def _label(value):
+	return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
 def debug(value):
+	'''Control whether or not every frame sent and received is logged,
+	at DEBUG level on the "chatango" logger. If logging hasn't been
+	set up, they're written to stderr.'''
 	global _DEBUG
 	_DEBUG = bool(value)
+	if _DEBUG:
+		if not _log.isEnabledFor(logging.DEBUG):
+			_log.setLevel(logging.DEBUG)
+		if not _log.hasHandlers():
+			_log.addHandler(logging.StreamHandler())
 
-_DEBUG = True
+_DEBUG = False
+_log = logging.getLogger("chatango")
+_reconnects = reconnector()
+_send_limit = None
+_server_override = None
+_directory = None
+_supervisors = weakref.WeakSet()
+_flood = None
+_auth_cache = {}
 _server_weights = {'specials': {'mitvcanal': 56, 'animeultimacom': 34, 'cricket365live': 21, 'pokemonepisodeorg': 22, 'animelinkz': 20, 'sport24lt': 56, 'narutowire': 10, 'watchanimeonn': 22, 'cricvid-hitcric-': 51, 'narutochatt': 70, 'leeplarp': 27, 'stream2watch3': 56, 'ttvsports': 56, 'ver-anime': 8, 'vipstand': 21, 'eafangames': 56, 'soccerjumbo': 21, 'myfoxdfw': 67, 'kiiiikiii': 21, 'de-livechat': 5, 'rgsmotrisport': 51, 'dbzepisodeorg': 10, 'watch-dragonball': 8, 'peliculas-flv': 69, 'tvanimefreak': 54, 'tvtvanimefreak': 54}, 'weights' : [['5', 75], ['6', 75], ['7', 75], ['8', 75], ['16', 75], ['17', 75], ['18', 75], ['9', 95], ['11', 95], ['12', 95], ['13', 95], ['14', 95], ['15', 95], ['19', 110], ['23', 110], ['24', 110], ['25', 110], ['26', 110], ['28', 104], ['29', 104], ['30', 104], ['31', 104], ['32', 104], ['33', 104], ['35', 101], ['36', 101], ['37', 101], ['38', 101], ['39', 101], ['40', 101], ['41', 101], ['42', 101], ['43', 101], ['44', 101], ['45', 101], ['46', 101], ['47', 101], ['48', 101], ['49', 101], ['50', 101], ['52', 110], ['53', 110], ['55', 110], ['57', 110], ['58', 110], ['59', 110], ['60', 110], ['61', 110], ['62', 110], ['63', 110], ['64', 110], ['65', 110], ['66', 110], ['68', 95], ['71', 116], ['72', 116], ['73', 116], ['74', 116], ['75', 116], ['76', 116], ['77', 116], ['78', 116], ['79', 116], ['80', 116], ['81', 116], ['82', 116], ['83', 116], ['84', 116]]}
 _font_family = {"arial": "0", "comic": "1", "georgia": "2", "handwriting": "3", "impact": "4", "palatino": "5", "papyrus": "6", "times": "7", "typewriter": "8"}
+_archive_record = struct.Struct("<dBQHHHHI")
+_archive_entry = struct.Struct("<ddQQQ")
+_archive_top = struct.Struct("<d")
+_ARCHIVE_RECENT = 10000
+_SHARD_EVENTS, _SHARD_REPLY = 0, 1
+_PARTICIPANTS_SLICE = 2000
+_MESSAGE_LIMIT = 1800
+_DISPATCH_BATCH = 50
+_PACK_PLAIN, _PACK_MESSAGE, _PACK_USER, _PACK_ROOM, _PACK_LIST, _PACK_DICT = range(6)
+_prometheus_metrics = [
+	("frames_received_total", "counter", "frames_in", "Frames read from chatango."),
+	("bytes_received_total", "counter", "bytes_in", "Bytes read from chatango."),
+	("frames_sent_total", "counter", "frames_out", "Frames sent to chatango."),
+	("bytes_sent_total", "counter", "bytes_out", "Bytes sent to chatango."),
+	("events_queued", "gauge", "events_queued", "Events waiting to be picked up."),
+	("frames_queued", "gauge", "frames_queued", "Frames waiting to be sent."),
+	("reconnects_total", "counter", "reconnects", "Times the connection was reestablished."),
+	("pending_messages", "gauge", "pending_messages", "New messages waiting for an mid."),
+	("pending_matched_total", "counter", "pending_matched", "New messages that got their mid."),
+	("pending_expired_total", "counter", "pending_expired", "New messages given up on before getting an mid."),
+	("event_delivery_seconds", "summary", "delivery_latency", "Time from reading an event's frame to the event being picked up."),
+]
+_tag_regx = re.compile("<[^>]+>")
+_entity_regx = re.compile("&(#?\\w+);")
+_head_regx = re.compile('(?:<n([0-9a-fA-F]+)/>)?(?:<f x(\\d\\d)?([0-9a-fA-F]{3,6})?="([^"]*)">)?')
+_entities = dict((x, chr(y)) for x, y in html.entities.name2codepoint.items())
+_entities["apos"] = "'"
 _font_family_nums = {'1': 'comic', '0': 'arial', '3': 'handwriting', '2': 'georgia', '5': 'palatino', '4': 'impact', '7': 'times', '6': 'papyrus', '8': 'typewriter'}
+_server_table = _build_server_table(_server_weights["weights"])